@@ -0,0 +1,380 @@
+"""
+Benchmarks for the hot paths of the project.
+Every benchmark runs on synthetic seasons generated locally in the shape that DataCleaner produces, so no raw
+data is needed and runs are reproducible. Run this module directly to run the suite. Results can be saved as JSON
+and compared against a saved baseline to flag regressions.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+# Logging
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(levelname)s: \n %(message)s \n"
+)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+from config import Config
+from model import FeedforwardNeuralNetModel, compile_model
+from nnmodeldataset import BatchLoader, NNModelDataSet
+from player_registry import PlayerRegistry
+from roto_calculator import RotoCalculator
+from storage import Manifest, STORAGE_BACKENDS, find_manifests, read_manifests
+from utils import calculate_team_features, calculate_team_prev_season_data
+
+# Relative drop in a throughput metric, compared to the baseline, that is reported as a regression.
+REGRESSION_TOLERANCE = 0.1
+
+
+def synthetic_seasons(num_seasons=2, players_per_season=300, first_season=2000, seed=0):
+    """
+    Build season dictionaries shaped like the output of DataCleaner.data_cleaning_pipeline.
+    The same players appear in every season, so each season has previous season data.
+    :return: A tuple (training_data, normalized_training_data).
+    """
+    rng = np.random.default_rng(seed)
+    config = Config()
+    per_game_stats = ["MP", "FG", "FGA", "3P", "FT", "FTA", "TRB", "AST", "STL"]
+    per_game_stats += ["BLK", "TOV", "PTS"]
+    training_data, normalized_training_data = {}, {}
+    for season in range(first_season, first_season + num_seasons):
+        season_data = {}
+        for i in range(players_per_season):
+            games = int(rng.integers(20, 83))
+            fga = int(rng.integers(50, 1500))
+            fta = int(rng.integers(10, 600))
+            stats = {
+                "Age": int(rng.integers(19, 40)),
+                "G": games,
+                "GS": int(rng.integers(0, games + 1)),
+                "MP": int(rng.integers(300, 3200)),
+                "FG": int(fga * rng.uniform(0.35, 0.6)),
+                "FGA": fga,
+                "3P": int(rng.integers(0, 250)),
+                "FT": int(fta * rng.uniform(0.5, 0.9)),
+                "FTA": fta,
+                "TRB": int(rng.integers(50, 900)),
+                "AST": int(rng.integers(20, 700)),
+                "STL": int(rng.integers(5, 150)),
+                "BLK": int(rng.integers(0, 150)),
+                "TOV": int(rng.integers(10, 300)),
+                "PTS": int(rng.integers(100, 2500)),
+            }
+            for stat in per_game_stats:
+                stats[f"{stat}/game"] = stats[stat] / games
+            season_data[f"Player {i}"] = stats
+        training_data[season] = season_data
+        normalized_training_data[season] = {
+            player: {stat: float(rng.random()) for stat in config.feature_columns}
+            for player in season_data
+        }
+    return training_data, normalized_training_data
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if platform.system() == "Darwin" else peak / (1 << 10)
+
+
+def synthetic_dataset(num_rows, num_features=15, seed=0):
+    """
+    Build a dataset shaped like the generated training data.
+    :return: A NNModelDataSet with uniform features and integer labels.
+    """
+    rng = np.random.default_rng(seed)
+    config = Config()
+    X = rng.random((num_rows, num_features), dtype=np.float32)
+    max_points = 9 * config.num_teams
+    y = rng.integers(9, max_points + 1, size=num_rows).astype(np.float32)
+    return NNModelDataSet(X=X, y=y)
+
+
+def time_epoch(data_loader, model=None):
+    """
+    Time one pass over a data loader. With a model, every batch also runs a training step.
+    :return: The epoch time in seconds.
+    """
+    if model is not None:
+        optimizer = torch.optim.Adam(model.parameters())
+        criterion = torch.nn.MSELoss()
+    start = time.perf_counter()
+    for data, labels in data_loader:
+        if model is not None:
+            optimizer.zero_grad()
+            loss = criterion(model(data), labels)
+            loss.backward()
+            optimizer.step()
+    return time.perf_counter() - start
+
+
+def benchmark_data_loaders(num_rows=200000, batch_size=None, train=True):
+    """
+    Compare the epoch time of DataLoader against BatchLoader on the same dataset.
+    :param num_rows: Number of rows in the synthetic dataset.
+    :param batch_size: Defaults to Config.batch_size.
+    :param train: If True, each batch also runs a training step of FeedforwardNeuralNetModel.
+    :return: A dictionary with the rows per second of an epoch with each loader, i.e.
+        'batch_loader_rows_per_sec', or 'batch_loader_train_rows_per_sec' with train.
+    """
+    batch_size = batch_size or Config().batch_size
+    dataset = synthetic_dataset(num_rows)
+    loaders = {
+        "torch_data_loader": DataLoader(dataset, batch_size=batch_size, shuffle=True),
+        "batch_loader": BatchLoader(dataset, batch_size=batch_size),
+        "batch_loader_prefetch": BatchLoader(
+            dataset, batch_size=batch_size, prefetch_batches=4
+        ),
+    }
+    results = {}
+    for name, loader in loaders.items():
+        model = (
+            FeedforwardNeuralNetModel(input_dim=dataset.input_size) if train else None
+        )
+        epoch_time = time_epoch(loader, model=model)
+        logger.info(
+            f"{name}: {epoch_time:.3f}s per epoch of {num_rows} rows (batch size {batch_size}, train={train})."
+        )
+        metric = f"{name}_train_rows_per_sec" if train else f"{name}_rows_per_sec"
+        results[metric] = num_rows / epoch_time
+    return results
+
+
+def benchmark_simulation(num_simulations=20000, batch_size=None):
+    """
+    :return: A dictionary with the simulations per second of the batch engine and of run_simulation.
+    """
+    config = Config()
+    batch_size = batch_size or config.simulation_batch_size
+    training_data, _ = synthetic_seasons(num_seasons=1)
+    season_data = next(iter(training_data.values()))
+    roto_calculator = RotoCalculator(season_data, rng=np.random.default_rng(0))
+
+    start = time.perf_counter()
+    for batch_start in range(0, num_simulations, batch_size):
+        roto_calculator.run_simulation_batch(
+            min(batch_size, num_simulations - batch_start)
+        )
+    batch_time = time.perf_counter() - start
+
+    # The dict-based path is much slower, so it gets fewer simulations.
+    num_dict_simulations = max(num_simulations // 20, 1)
+    start = time.perf_counter()
+    for _ in range(num_dict_simulations):
+        roto_calculator.run_simulation()
+    dict_time = time.perf_counter() - start
+    return {
+        "simulations_per_sec": num_simulations / batch_time,
+        "dict_simulations_per_sec": num_dict_simulations / dict_time,
+    }
+
+
+def benchmark_feature_extraction(num_teams=200000):
+    """
+    :return: A dictionary with the feature rows per second of calculate_team_features and of
+        calculate_team_prev_season_data.
+    """
+    config = Config()
+    training_data, normalized_training_data = synthetic_seasons(num_seasons=2)
+    season = max(training_data)
+    registry = PlayerRegistry(
+        training_data, normalized_training_data, config.feature_columns
+    )
+    rng = np.random.default_rng(0)
+    rosters = np.stack(
+        [
+            rng.choice(registry.num_players(season), config.team_size, replace=False)
+            for _ in range(num_teams)
+        ]
+    )
+
+    start = time.perf_counter()
+    calculate_team_features(rosters, registry.prev_season_features(season))
+    matrix_time = time.perf_counter() - start
+
+    num_dict_teams = max(num_teams // 20, 1)
+    teams = registry.names(season, rosters[:num_dict_teams])
+    prev_season_data = normalized_training_data[season - 1]
+    start = time.perf_counter()
+    for team in teams:
+        calculate_team_prev_season_data(team, prev_season_data)
+    dict_time = time.perf_counter() - start
+    return {
+        "feature_rows_per_sec": num_teams / matrix_time,
+        "dict_feature_rows_per_sec": num_dict_teams / dict_time,
+    }
+
+
+def benchmark_data_loading(num_rows=500000, num_files=10, storage_formats=None):
+    """
+    Write a synthetic split in each storage format and time reading it back through the manifests.
+    :param storage_formats: Defaults to every backend whose dependencies are installed.
+    :return: A dictionary with the MB/s of loading, per storage format.
+    """
+    config = Config()
+    columns = config.vector_columns
+    data = synthetic_dataset(num_rows, num_features=len(columns) - 1)
+    table = torch.cat([data.data, data.labels], dim=1).numpy()
+    size_mb = table.nbytes / (1 << 20)
+    results = {}
+    for storage_format in storage_formats or list(STORAGE_BACKENDS):
+        storage = STORAGE_BACKENDS[storage_format]()
+        with tempfile.TemporaryDirectory() as data_dir:
+            manifest = Manifest(data_dir)
+            try:
+                for i, rows in enumerate(np.array_split(table, num_files)):
+                    file_name = f"{i:04d}{storage.extension}"
+                    storage.write(os.path.join(data_dir, file_name), rows, columns)
+                    manifest.add(file_name, columns=columns, rows=len(rows))
+            except ImportError as e:
+                logger.info(f"Skipping {storage_format}: {e}")
+                continue
+            start = time.perf_counter()
+            read_manifests(find_manifests(data_dir), columns=columns)
+            results[f"{storage_format}_load_mb_per_sec"] = size_mb / (
+                time.perf_counter() - start
+            )
+    return results
+
+
+def benchmark_training(num_rows=200000, batch_size=None):
+    """
+    :return: A dictionary with the training samples per second of one epoch with the batch loader.
+    """
+    batch_size = batch_size or Config().batch_size
+    torch.manual_seed(0)
+    dataset = synthetic_dataset(num_rows)
+    model = FeedforwardNeuralNetModel(input_dim=dataset.input_size)
+    loader = BatchLoader(dataset, batch_size=batch_size)
+    return {"training_samples_per_sec": num_rows / time_epoch(loader, model=model)}
+
+
+def benchmark_compile_modes(
+    num_rows=200000,
+    batch_sizes=(100, 1024, 8192),
+    compile_modes=(None, "torchscript", "compile"),
+):
+    """
+    Compare the training throughput of the model run eagerly and compiled, at several batch sizes.
+    Every model first trains on a few batches, including a smaller one, so that compilation is not timed.
+    :return: A dictionary with the training samples per second of each compile mode and batch size.
+    """
+    dataset = synthetic_dataset(num_rows)
+    results = {}
+    for batch_size in batch_sizes:
+        warmup_dataset = synthetic_dataset(2 * batch_size + 1)
+        for compile_mode in compile_modes:
+            torch.manual_seed(0)
+            model = compile_model(
+                FeedforwardNeuralNetModel(input_dim=dataset.input_size), compile_mode
+            )
+            time_epoch(BatchLoader(warmup_dataset, batch_size=batch_size), model=model)
+            epoch_time = time_epoch(
+                BatchLoader(dataset, batch_size=batch_size), model=model
+            )
+            name = (
+                f"{compile_mode or 'eager'}_training_samples_per_sec_batch_{batch_size}"
+            )
+            results[name] = num_rows / epoch_time
+            logger.info(f"{name}: {results[name]:.0f}")
+    return results
+
+
+def run_benchmarks(quick=False):
+    """
+    Run the whole suite.
+    :param quick: If True, run every benchmark at a tenth of its size.
+    :return: A dictionary with the metrics and information about the run.
+    """
+    scale = 10 if quick else 1
+    metrics = {}
+    for benchmark, kwargs in [
+        (benchmark_simulation, {"num_simulations": 20000 // scale}),
+        (benchmark_feature_extraction, {"num_teams": 200000 // scale}),
+        (benchmark_data_loading, {"num_rows": 500000 // scale}),
+        (benchmark_data_loaders, {"num_rows": 200000 // scale, "train": False}),
+        (benchmark_data_loaders, {"num_rows": 200000 // scale, "train": True}),
+        (benchmark_training, {"num_rows": 200000 // scale}),
+        (benchmark_compile_modes, {"num_rows": 200000 // scale}),
+    ]:
+        logger.info(f"Running {benchmark.__name__}...")
+        metrics.update(benchmark(**kwargs))
+    metrics["peak_rss_mb"] = peak_rss_mb()
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "quick": quick,
+        "metrics": metrics,
+    }
+
+
+def save_results(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def compare_to_baseline(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """
+    Compare the metrics of a run against a baseline run.
+    Every metric is a throughput (higher is better), except peak_rss_mb (lower is better).
+    :return: A list of messages, one per regressed metric.
+    """
+    regressions = []
+    for metric, baseline_value in baseline["metrics"].items():
+        value = results["metrics"].get(metric)
+        if value is None or not baseline_value:
+            continue
+        change = (value - baseline_value) / baseline_value
+        if metric == "peak_rss_mb":
+            change = -change
+        if change < -tolerance:
+            regressions.append(
+                f"{metric}: {value:.1f} vs baseline {baseline_value:.1f} ({change:+.1%})"
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--output", help="Path of the JSON file to save the results to."
+    )
+    parser.add_argument("--baseline", help="Path of a saved run to compare against.")
+    parser.add_argument("--quick", action="store_true", help="Run smaller benchmarks.")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=REGRESSION_TOLERANCE,
+        help="Relative drop in a metric that counts as a regression.",
+    )
+    args = parser.parse_args()
+
+    results = run_benchmarks(quick=args.quick)
+    logger.info(json.dumps(results["metrics"], indent=2, sort_keys=True))
+    if args.output:
+        save_results(results, args.output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            logger.info(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
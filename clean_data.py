@@ -2,6 +2,9 @@
 The purpose of this module is to clean the data so we can use it for training.
 """
 
+import hashlib
+import os
+import pickle
 
 import pandas as pd
 
@@ -20,17 +23,56 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 from config import Config
+from instrumentation import metrics
+from player_registry import PlayerRegistry
+
+# Bump this whenever the cleaning logic changes, so stale cache entries are not reused.
+CACHE_VERSION = 2
+
+
+def _hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else repr(part).encode())
+    return digest.hexdigest()
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _load_pickle(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def _save_pickle(path, obj):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
 
 
 class DataCleaner:
-    def __init__(self):
-        self.season_stats = pd.read_csv("raw_data/season_stats.csv")
+    def __init__(self, raw_data_path="raw_data/season_stats.csv"):
+        self.raw_data_path = raw_data_path
+        self.season_stats = None
         config = Config()
         self.earliest_season = config.start_year
+        self.players_per_season = config.players_per_season
+        self.cache_dir = config.cache_dir
+        self.feature_columns = config.feature_columns
         self.players = set()
         self.stats_by_season = {}
         self.training_data = {}
         self.normalized_training_data = {}
+        # Integer player IDs per season, built by the pipeline.
+        self.player_registry = None
 
     def _clean_season_stats(self):
         """
@@ -39,6 +81,7 @@ class DataCleaner:
         :return: None
         """
         logger.info("Reading season stats data...")
+        self.season_stats = pd.read_csv(self.raw_data_path)
         # Select the stats we want.
         stats = [
             "Year",
@@ -50,6 +93,7 @@ class DataCleaner:
             "FG",
             "FGA",
             "3P",
+            "3PA",
             "FT",
             "FTA",
             "TRB",
@@ -64,7 +108,10 @@ class DataCleaner:
             self.season_stats["Year"] >= self.earliest_season
         ]
         # Sort dataframe by minutes played. This is in case of duplicate names, we take the more "popular" player.
-        self.season_stats = self.season_stats.sort_values(["MP"], ascending=[False])
+        # The sort is stable, so ties keep the file order and a season's rows do not depend on other seasons.
+        self.season_stats = self.season_stats.sort_values(
+            ["MP"], ascending=[False], kind="stable"
+        )
         # Drop duplicate players.
         self.season_stats = self.season_stats.drop_duplicates(
             ["Player", "Year"], ignore_index=True
@@ -101,70 +148,100 @@ class DataCleaner:
             f"Found {len(self.season_stats)} player season records from {self.earliest_season}-{max(self.season_stats['Year'])}."
         )
 
-    def _select_training_data(self):
+    def _select_training_data(self, years=None):
         """
         The idea is for each year, we select the top 300 players by minutes played.
         This is to avoid the problem of injuries messing up model training.
         We will not include rookies in each year, since we do not have historical data for them.
+        :param years: Optional collection of years to compute. Defaults to every year.
         :return: None
         """
 
         self.stats_by_season = {}
 
         latest_season = max(self.season_stats["Year"])
-        for year in range(self.earliest_season, latest_season + 1):
-            stats_in_year = self.season_stats.loc[self.season_stats["Year"] == year]
-            # Only take top 300 players by minutes played each season.
-            stats_in_year = stats_in_year.head(300)
-            stats_in_year.set_index("Player", inplace=True)
-            stats_in_year.drop("Year", axis=1, inplace=True)
-            player_stats_for_year = stats_in_year.to_dict(orient="index")
-            self.stats_by_season[year] = player_stats_for_year
-
-            # Historically, there have been a few seasons that have had less games played.
-            # Additionally, certain metrics will change over time (i.e. points, 3-pointers made).
-            # We want to normalize the stats for each season as well for training.
-            normalized_stats = (stats_in_year - stats_in_year.min()) / (
-                stats_in_year.max() - stats_in_year.min()
-            )
-            # For normalized stats, they will only be used as features, not evaluation.
-            # So we only need the per-game stats.
-            total_stat_cols = [
-                "FG",
-                "FGA",
-                "MP",
-                "3P",
-                "FT",
-                "FTA",
-                "TRB",
-                "AST",
-                "STL",
-                "BLK",
-                "TOV",
-                "PTS",
-            ]
-            normalized_stats.drop(total_stat_cols, axis=1, inplace=True)
-            normalized_player_stats_for_year = normalized_stats.to_dict(orient="index")
-            self.normalized_training_data[year] = normalized_player_stats_for_year
+        if years is None:
+            years = range(self.earliest_season, latest_season + 1)
+        # The rookie filter of a year also needs the players of the previous year.
+        needed_years = sorted(
+            {year for year in years}
+            | {year - 1 for year in years if year > self.earliest_season}
+        )
+        stats = self.season_stats.loc[self.season_stats["Year"].isin(needed_years)]
+        # Only take top 300 players by minutes played each season.
+        stats = stats.groupby("Year", sort=False).head(self.players_per_season)
+
+        # Historically, there have been a few seasons that have had less games played.
+        # Additionally, certain metrics will change over time (i.e. points, 3-pointers made).
+        # We want to normalize the stats for each season as well for training.
+        stat_cols = [col for col in stats.columns if col not in ["Year", "Player"]]
+        # For normalized stats, they will only be used as features, not evaluation.
+        # So we only need the per-game stats.
+        total_stat_cols = [
+            "FG",
+            "FGA",
+            "MP",
+            "3P",
+            "3PA",
+            "FT",
+            "FTA",
+            "TRB",
+            "AST",
+            "STL",
+            "BLK",
+            "TOV",
+            "PTS",
+        ]
+        feature_cols = [col for col in stat_cols if col not in total_stat_cols]
+        grouped = stats.groupby("Year", sort=False)[feature_cols]
+        season_min = grouped.transform("min")
+        normalized_stats = (stats[feature_cols] - season_min) / (
+            grouped.transform("max") - season_min
+        )
+        normalized_stats.index = stats["Player"]
 
         # Now remove rookies and players that did not play in the previous year from each year.
-        final_stats_by_season = {
-            self.earliest_season: self.stats_by_season[self.earliest_season]
-        }
+        # This is a semi-join of (Player, Year) against the (Player, Year + 1) of the selected players.
+        prev_season_keys = pd.MultiIndex.from_arrays(
+            [stats["Player"], stats["Year"] + 1]
+        )
+        keep = (
+            pd.MultiIndex.from_arrays([stats["Player"], stats["Year"]]).isin(
+                prev_season_keys
+            )
+            | (stats["Year"] == self.earliest_season).to_numpy()
+        )
 
-        for year in range(self.earliest_season + 1, latest_season + 1):
-            players = list(self.stats_by_season[year].keys())
-            final_players_for_season = {}
-            for player in players:
-                if player in self.stats_by_season[year - 1]:
-                    final_players_for_season[player] = self.stats_by_season[year][
-                        player
-                    ]
+        stats = stats.set_index("Player")
+        stats_by_year = dict(list(stats.groupby("Year", sort=False)))
+        normalized_by_year = dict(
+            list(normalized_stats.groupby(stats["Year"].to_numpy(), sort=False))
+        )
+        keep_by_year = dict(list(stats[keep].groupby("Year", sort=False)))
+        empty = stats.iloc[:0]
 
-            final_stats_by_season[year] = final_players_for_season
-            logger.info(
-                f"{len(final_players_for_season.keys())} players selected for year {year}."
+        for year in needed_years:
+            self.stats_by_season[year] = (
+                stats_by_year.get(year, empty)
+                .drop("Year", axis=1)
+                .to_dict(orient="index")
+            )
+            self.normalized_training_data[year] = normalized_by_year.get(
+                year, empty[feature_cols]
+            ).to_dict(orient="index")
+
+        final_stats_by_season = {}
+        for year in sorted(years):
+            final_players_for_season = (
+                keep_by_year.get(year, empty)
+                .drop("Year", axis=1)
+                .to_dict(orient="index")
             )
+            final_stats_by_season[year] = final_players_for_season
+            if year > self.earliest_season:
+                logger.info(
+                    f"{len(final_players_for_season.keys())} players selected for year {year}."
+                )
         self.training_data = final_stats_by_season
 
     def _validate_data(self):
@@ -178,13 +255,109 @@ class DataCleaner:
                     )
         logger.info("Player data validated.")
 
-    def data_cleaning_pipeline(self):
+    def _season_cache_keys(self):
+        """
+        Hash the inputs of each season. A season's output depends on its own cleaned rows and,
+        through the rookie filter, on the rows of the previous season.
+        :return: A dictionary with years as keys and cache keys as values.
+        """
+        latest_season = max(self.season_stats["Year"])
+        row_hashes = {
+            year: pd.util.hash_pandas_object(stats_in_year, index=False)
+            .to_numpy()
+            .tobytes()
+            for year, stats_in_year in self.season_stats.groupby("Year", sort=False)
+        }
+        empty_hash = (
+            pd.util.hash_pandas_object(self.season_stats.iloc[:0], index=False)
+            .to_numpy()
+            .tobytes()
+        )
+        row_hashes = {
+            year: row_hashes.get(year, empty_hash)
+            for year in range(self.earliest_season - 1, latest_season + 1)
+        }
+        return {
+            year: _hash(
+                CACHE_VERSION,
+                self.players_per_season,
+                year == self.earliest_season,
+                row_hashes[year],
+                row_hashes[year - 1],
+            )
+            for year in range(self.earliest_season, latest_season + 1)
+        }
+
+    def _run_cached_pipeline(self):
+        """
+        Clean the raw data, only recomputing the seasons whose inputs are not in the cache.
+        :return: None
+        """
+        self._clean_season_stats()
+        season_keys = self._season_cache_keys()
+        season_dir = os.path.join(self.cache_dir, "seasons")
+        cached = {
+            year: os.path.join(season_dir, f"{key}.pkl")
+            for year, key in season_keys.items()
+        }
+        stale_years = [
+            year for year, path in cached.items() if not os.path.exists(path)
+        ]
+        logger.info(
+            f"Recomputing {len(stale_years)} of {len(season_keys)} seasons, the rest come from the cache."
+        )
+
+        training_data, normalized_training_data = {}, {}
+        if stale_years:
+            self._select_training_data(years=stale_years)
+            for year in stale_years:
+                _save_pickle(
+                    cached[year],
+                    (self.training_data[year], self.normalized_training_data[year]),
+                )
+        for year, path in cached.items():
+            training_data[year], normalized_training_data[year] = _load_pickle(path)
+        self.training_data = training_data
+        self.normalized_training_data = normalized_training_data
+
+    def data_cleaning_pipeline(self, use_cache=True):
         """
         Run the data cleaning pipeline to get a training dataset.
+        Results are cached in Config.cache_dir, keyed on the raw data file, the start year and the number of
+        players kept per season. If the raw file changed, only the seasons whose inputs changed are recomputed.
+        :param use_cache: If False, always recompute everything.
+        The pipeline also builds self.player_registry, which maps the players of each season to integer IDs.
         :return: A dictionary with years as keys, and the values are dictionaries with players as keys
                     and their stats as values.
         """
-        self._clean_season_stats()
-        self._select_training_data()
-        self._validate_data()
+        with metrics.timer("cleaning"):
+            if not use_cache:
+                self._clean_season_stats()
+                self._select_training_data()
+                self._validate_data()
+            else:
+                self._load_or_run_cached_pipeline()
+
+        self.player_registry = PlayerRegistry(
+            season_stats=self.training_data,
+            normalized_season_stats=self.normalized_training_data,
+            feature_columns=self.feature_columns,
+        )
         return self.training_data, self.normalized_training_data
+
+    def _load_or_run_cached_pipeline(self):
+        cache_key = _hash(
+            CACHE_VERSION,
+            _hash_file(self.raw_data_path),
+            self.earliest_season,
+            self.players_per_season,
+        )
+        cache_path = os.path.join(self.cache_dir, f"cleaned_{cache_key}.pkl")
+        if os.path.exists(cache_path):
+            logger.info("Loading cleaned data from the cache...")
+            self.training_data, self.normalized_training_data = _load_pickle(cache_path)
+            return
+
+        self._run_cached_pipeline()
+        self._validate_data()
+        _save_pickle(cache_path, (self.training_data, self.normalized_training_data))
@@ -4,16 +4,63 @@ A configuration file for some key settings.
 
 
 class Config:
-    def __init__(self):
+    def __init__(self, overrides=None):
+        """
+        Constructor.
+        :param overrides: Optional dictionary of settings replacing the defaults below, i.e.
+            {"learning_rate": 0.01, "model_path": "models/trial.pt"}. Keys are the model config keys, or the names
+            of the other settings without the leading underscore. Used to train model variants.
+        """
         # Start year for collecting data.
         self._start_year = 2000
 
+        # Number of players selected per season, by minutes played.
+        self._players_per_season = 300
+
+        # Directory for cached intermediate results, such as the cleaned season data.
+        self._cache_dir = "cache"
+
         # Number of teams in the fantasy league.
         self._num_teams = 8
 
         # Number of players per team.
         self._team_size = 13
 
+        # Scoring rules of the league, compiled by scoring.compile_scoring.
+        # format is "roto", "h2h_categories" or "points".
+        # Category leagues list their categories. FG%, FT% and 3P% are ratios of the team's summed makes and
+        # attempts, any other category is a stat column summed over the roster. Categories in lower_is_better
+        # are ranked ascending. For example, 8-cat drops TOV, and 11-cat adds 3P% and another stat column.
+        # Points leagues use the points per unit of each stat instead.
+        self._scoring = {
+            "format": "roto",
+            "categories": [
+                "FG%",
+                "FT%",
+                "3P",
+                "STL",
+                "AST",
+                "TRB",
+                "TOV",
+                "BLK",
+                "PTS",
+            ],
+            "lower_is_better": ["TOV"],
+            "points": {
+                "PTS": 1,
+                "3P": 1,
+                "FGA": -1,
+                "FG": 2,
+                "FTA": -1,
+                "FT": 1,
+                "TRB": 1,
+                "AST": 2,
+                "STL": 4,
+                "BLK": 4,
+                "TOV": -2,
+            },
+        }
+
         # The years that will be used for model training.
         self._training_years = [
             2001,
@@ -38,6 +85,77 @@ class Config:
         # Number of training simulations to run per season.
         self._simulations_per_season = 10000
 
+        # How the leagues of the training simulations are drawn:
+        # "uniform" draws every roster uniformly at random from the season's players.
+        # "snake_adp" runs a snake draft in order of average draft position, estimated from the players'
+        # previous season minutes per game, with normal noise of adp_noise picks on every player's position.
+        # "stratified" splits the players into sampler_tiers tiers by draft position, and draws a fixed number
+        # of each league's players from every tier, set by tier_allocation.
+        self._league_sampler = "uniform"
+
+        # Standard deviation of each draft position around the player's ADP, in picks, for the snake_adp sampler.
+        self._adp_noise = 10.0
+
+        # Number of tiers of the stratified sampler.
+        self._sampler_tiers = 4
+
+        # Fraction of each league's players drawn from each tier, best tier first. None allocates proportionally
+        # to the tier sizes. Rows are weighted by how much their tiers are over- or under-sampled relative to the
+        # proportional allocation, so every weight is 1 with None.
+        self._tier_allocation = None
+
+        # If True, leagues are drawn in antithetic pairs: the second league of a pair reuses the random draws of
+        # the first one, mirrored (u becomes 1 - u and z becomes -z).
+        self._antithetic_sampling = False
+
+        # Number of leagues simulated together by the vectorized roto engine.
+        self._simulation_batch_size = 1000
+
+        # Number of simulations in each shard of a season. Shards are the unit of work handed to a worker,
+        # each one draws from its own RNG stream and is flushed to its own file as soon as it is done.
+        # This bounds memory use during generation. Set to None to use one shard per season.
+        self._simulations_per_shard = 10000
+
+        # Number of worker processes used to generate training data, and to simulate leagues during online
+        # training. 1 runs everything in this process.
+        self._num_workers = 1
+
+        # Number of threads PyTorch uses within an operation (intra-op) and to run operations concurrently
+        # (inter-op) during training. None keeps PyTorch's default, which is every core. Set these on shared hosts,
+        # so that training does not oversubscribe the CPUs.
+        self._num_threads = None
+        self._num_interop_threads = None
+
+        # Root seed for the simulations. Each (season, shard) pair derives its own stream from it, so the output
+        # does not depend on the number of workers.
+        self._random_seed = 2021
+
+        # File format of the generated data: csv, npy, feather or parquet. Feather and parquet require pyarrow.
+        self._storage_format = "npy"
+
+        # If True, training simulates fresh leagues of the training years on the fly instead of reading the
+        # generated files, and the test and validation years are simulated once in memory. Nothing is written.
+        self._online_training = False
+
+        # Number of training rows simulated per epoch in online training.
+        self._online_rows_per_epoch = 1000000
+
+        # If True, training memory-maps the .npy data files instead of reading them into memory.
+        # Use this for datasets larger than RAM. Requires the npy storage format.
+        self._memory_map_data = False
+
+        # If True, time the stages of the pipeline and log latency histograms and throughput.
+        self._instrumentation = True
+
+        # If set, every metrics summary is also appended to this file as a JSON line.
+        self._metrics_file = "metrics/metrics.jsonl"
+
+        # Profiler for the main stages: None, "cprofile" or "pyinstrument" (requires pyinstrument).
+        self._profiler = None
+
+        # Directory where profiler output is written.
+        self._profile_dir = "profiles"
+
         # Column names for feature vector (and label).
         self._vector_columns = [
             "Age",
@@ -61,6 +179,16 @@ class Config:
         # If True, do train-test-val split from all seasons. Otherwise, use the defined seasons for train-test-val.
         self._combine_data = False
 
+        # Where the trained model is saved, and loaded from for prediction.
+        self._model_path = "models/model.pt"
+
+        # Where the trainer state (model, optimizer, epoch, early stopping and RNG states) is saved after every
+        # epoch. Set to None to disable checkpointing.
+        self._checkpoint_path = "models/checkpoint.pt"
+
+        # If True, training resumes from the checkpoint when there is one.
+        self._resume_training = False
+
         # ML configurations.
         self._model_configs = {
             "hidden_layer_sizes": [32, 16],
@@ -72,12 +200,42 @@ class Config:
             "weight_decay": 0.01,  # L2 regularization. Should be between 0 (no decay) and 0.1.
             "epochs": 500,
             "batch_size": 100,
+            "data_loader": "batch",  # [batch torch] batch gathers whole batches by index, torch uses DataLoader.
+            "prefetch_batches": 0,  # Batches prepared ahead by a background thread with the batch loader.
+            "early_stopping_patience": 20,  # Epochs without validation improvement before stopping. None disables.
+            "early_stopping_min_delta": 0.0,  # Minimum decrease of the validation loss that counts as improvement.
+            "gradient_accumulation_steps": 1,  # Batches whose gradients are averaged in every optimizer step.
+            # Large-batch training: the learning rate is tuned at base_batch_size, and scaled to the effective batch
+            # size (batch_size * gradient_accumulation_steps) with lr_scaling [None linear sqrt]. The learning rate
+            # then rises linearly over the first warmup_steps optimizer steps.
+            "base_batch_size": 100,
+            "lr_scaling": None,
+            "warmup_steps": 0,
+            "autocast_dtype": None,  # [None bfloat16] Precision of the forward pass. None is float32.
+            "compile_mode": None,  # [None torchscript compile] None runs the model eagerly.
+            "ensemble_size": 1,  # Number of models trained together as an ensemble. 1 trains a single model.
         }
 
+        for key, value in (overrides or {}).items():
+            if key in self._model_configs:
+                self._model_configs[key] = value
+            elif hasattr(self, f"_{key}"):
+                setattr(self, f"_{key}", value)
+            else:
+                raise KeyError(f"The following setting is not recognized: {key}")
+
     @property
     def start_year(self):
         return self._start_year
 
+    @property
+    def players_per_season(self):
+        return self._players_per_season
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
     @property
     def num_teams(self):
         return self._num_teams
@@ -86,6 +244,10 @@ class Config:
     def team_size(self):
         return self._team_size
 
+    @property
+    def scoring(self):
+        return self._scoring
+
     @property
     def training_years(self):
         return self._training_years
@@ -102,14 +264,112 @@ class Config:
     def simulations_per_season(self):
         return self._simulations_per_season
 
+    @property
+    def league_sampler(self):
+        return self._league_sampler
+
+    @property
+    def adp_noise(self):
+        return self._adp_noise
+
+    @property
+    def sampler_tiers(self):
+        return self._sampler_tiers
+
+    @property
+    def tier_allocation(self):
+        return self._tier_allocation
+
+    @property
+    def antithetic_sampling(self):
+        return self._antithetic_sampling
+
+    @property
+    def simulation_batch_size(self):
+        return self._simulation_batch_size
+
+    @property
+    def simulations_per_shard(self):
+        return self._simulations_per_shard
+
+    @property
+    def num_workers(self):
+        return self._num_workers
+
+    @property
+    def num_threads(self):
+        return self._num_threads
+
+    @property
+    def num_interop_threads(self):
+        return self._num_interop_threads
+
+    @property
+    def random_seed(self):
+        return self._random_seed
+
+    @property
+    def storage_format(self):
+        return self._storage_format
+
+    @property
+    def online_training(self):
+        return self._online_training
+
+    @property
+    def online_rows_per_epoch(self):
+        return self._online_rows_per_epoch
+
+    @property
+    def memory_map_data(self):
+        return self._memory_map_data
+
+    @property
+    def instrumentation(self):
+        return self._instrumentation
+
+    @property
+    def metrics_file(self):
+        return self._metrics_file
+
+    @property
+    def profiler(self):
+        return self._profiler
+
+    @property
+    def profile_dir(self):
+        return self._profile_dir
+
     @property
     def vector_columns(self):
         return self._vector_columns
 
+    @property
+    def feature_columns(self):
+        # The vector columns without the label.
+        return self._vector_columns[:-1]
+
+    @property
+    def data_columns(self):
+        # The columns of the generated data files: the vector columns followed by the row's sample weight.
+        return self._vector_columns + ["sample_weight"]
+
     @property
     def combine_data(self):
         return self._combine_data
 
+    @property
+    def model_path(self):
+        return self._model_path
+
+    @property
+    def checkpoint_path(self):
+        return self._checkpoint_path
+
+    @property
+    def resume_training(self):
+        return self._resume_training
+
     ########################################################
     # Neural Network properties
 
@@ -148,3 +408,47 @@ class Config:
     @property
     def batch_size(self):
         return self._model_configs["batch_size"]
+
+    @property
+    def data_loader(self):
+        return self._model_configs["data_loader"]
+
+    @property
+    def prefetch_batches(self):
+        return self._model_configs["prefetch_batches"]
+
+    @property
+    def early_stopping_patience(self):
+        return self._model_configs["early_stopping_patience"]
+
+    @property
+    def early_stopping_min_delta(self):
+        return self._model_configs["early_stopping_min_delta"]
+
+    @property
+    def gradient_accumulation_steps(self):
+        return self._model_configs["gradient_accumulation_steps"]
+
+    @property
+    def base_batch_size(self):
+        return self._model_configs["base_batch_size"]
+
+    @property
+    def lr_scaling(self):
+        return self._model_configs["lr_scaling"]
+
+    @property
+    def warmup_steps(self):
+        return self._model_configs["warmup_steps"]
+
+    @property
+    def autocast_dtype(self):
+        return self._model_configs["autocast_dtype"]
+
+    @property
+    def compile_mode(self):
+        return self._model_configs["compile_mode"]
+
+    @property
+    def ensemble_size(self):
+        return self._model_configs["ensemble_size"]
@@ -0,0 +1,125 @@
+"""
+Draft-time search for the best available pick, using a trained model.
+A roster is represented by the running sum of its players' normalized features, so adding a player is O(features).
+Every candidate pick, and every branch of the lookahead search, is scored in one batched forward pass.
+"""
+import numpy as np
+
+
+class DraftOptimizer:
+    def __init__(self, predictor, feature_matrix, roster=None):
+        """
+        Constructor.
+        :param predictor: A RosterPredictor.
+        :param feature_matrix: A (num_players, num_features) array of normalized player stats, indexed by player ID.
+        :param roster: Optional list of the player IDs already on the roster.
+        """
+        self.predictor = predictor
+        self.feature_matrix = np.asarray(feature_matrix, dtype=np.float64)
+        self.roster = []
+        self.feature_sum = np.zeros(self.feature_matrix.shape[1])
+        for player in roster or []:
+            self.add_player(player)
+
+    def add_player(self, player):
+        self.roster.append(player)
+        self.feature_sum += self.feature_matrix[player]
+
+    def remove_player(self, player):
+        self.roster.remove(player)
+        self.feature_sum -= self.feature_matrix[player]
+
+    def _score(self, feature_sums, roster_size):
+        """
+        :param feature_sums: An array of shape (..., num_features) of roster feature sums.
+        :param roster_size: Number of players in each of those rosters.
+        :return: An array of shape (...) of predicted fantasy points.
+        """
+        features = feature_sums / roster_size
+        predictions = self.predictor.predict_features(
+            features.reshape(-1, features.shape[-1])
+        )
+        return predictions.reshape(features.shape[:-1])
+
+    def rank_candidates(self, available):
+        """
+        Score the current roster plus each available player.
+        :param available: A list or array of the available player IDs.
+        :return: A list of (player ID, predicted points) tuples, best first.
+        """
+        available = np.asarray(available)
+        scores = self._score(
+            self.feature_sum + self.feature_matrix[available], len(self.roster) + 1
+        )
+        order = np.argsort(-scores, kind="stable")
+        return [(int(available[i]), float(scores[i])) for i in order]
+
+    def best_pick(self, available, lookahead=0, beam_width=10, picks_between=0):
+        """
+        Find the best pick, optionally looking ahead at our next picks with a beam search.
+        :param available: The available player IDs, ordered by average draft position (best first).
+        :param lookahead: Number of our future picks to search over after this one.
+        :param beam_width: Number of partial pick sequences kept after each ply.
+        :param picks_between: Number of picks the other teams make between two of ours. They are assumed to
+            take the best available players by draft position.
+        :return: A dictionary with keys 'player' (the pick), 'score' (predicted points of the final roster of
+            the best sequence) and 'sequence' (the best sequence of our picks).
+        """
+        available = np.asarray(available)
+        num_available = len(available)
+        candidate_features = self.feature_matrix[available]
+
+        # Beam state: the picks made so far (as positions in available), and the feature sum of the roster.
+        sequences = np.empty((1, 0), dtype=np.int64)
+        feature_sums = self.feature_sum[np.newaxis, :]
+        roster_size = len(self.roster)
+        scores = None
+
+        for ply in range(lookahead + 1):
+            # Positions taken so far, by us or by the other teams in draft position order.
+            taken = np.zeros((len(sequences), num_available), dtype=bool)
+            if sequences.shape[1]:
+                np.put_along_axis(taken, sequences, True, axis=1)
+            if ply and picks_between:
+                # The other teams pick the first picks_between * ply players we did not take.
+                others_taken = np.cumsum(~taken, axis=1) <= picks_between * ply
+                taken |= others_taken & ~taken
+
+            # Score every (sequence, candidate) pair in one batch.
+            candidate_scores = self._score(
+                feature_sums[:, np.newaxis, :] + candidate_features[np.newaxis, :, :],
+                roster_size + 1,
+            )
+            candidate_scores[taken] = -np.inf
+
+            # The beams hold distinct pick sets, so a set can only be reached from each of its ply + 1 subsets
+            # and the best beam_width * (ply + 1) candidates contain at least beam_width distinct sets.
+            kept = beam_width if ply < lookahead else 1
+            flat_order = np.argsort(-candidate_scores, axis=None, kind="stable")
+            flat_order = flat_order[: kept * (ply + 1)]
+            flat_order = flat_order[
+                np.isfinite(candidate_scores.reshape(-1)[flat_order])
+            ]
+            if len(flat_order) == 0:
+                break
+            beams, candidates = np.unravel_index(flat_order, candidate_scores.shape)
+            sequences = np.concatenate(
+                [sequences[beams], candidates[:, np.newaxis]], axis=1
+            )
+            # Orderings of the same picks end in the same roster, keep the best scored one of each.
+            _, first = np.unique(np.sort(sequences, axis=1), axis=0, return_index=True)
+            first = np.sort(first)[:kept]
+            beams, candidates = beams[first], candidates[first]
+            sequences = sequences[first]
+            feature_sums = feature_sums[beams] + candidate_features[candidates]
+            scores = candidate_scores[beams, candidates]
+            roster_size += 1
+
+        if sequences.shape[1] == 0:
+            raise ValueError("No players available to pick.")
+        best_sequence = [int(available[position]) for position in sequences[0]]
+        return {
+            "player": best_sequence[0],
+            "score": float(scores[0]),
+            "sequence": best_sequence,
+        }
@@ -0,0 +1,239 @@
+"""
+Lightweight instrumentation for the pipeline: stage timers with latency histograms, counters and optional
+profiling with cProfile or pyinstrument.
+Each process has its own Metrics object. Worker processes send snapshots of theirs back to be merged.
+"""
+from collections import defaultdict
+import cProfile
+from contextlib import contextmanager
+import json
+import math
+import os
+import time
+
+from config import Config
+
+
+class Histogram:
+    """
+    A latency histogram with logarithmic buckets. Bucket i holds durations in [2^(i/4), 2^((i+1)/4)) microseconds,
+    so percentiles are accurate to within about 20%.
+    """
+
+    buckets_per_octave = 4
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.buckets = defaultdict(int)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        microseconds = max(seconds * 1e6, 1.0)
+        self.buckets[int(math.log2(microseconds) * self.buckets_per_octave)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] += count
+
+    def percentile(self, q):
+        """
+        :param q: A percentile between 0 and 100.
+        :return: The upper edge of the bucket holding the percentile, in seconds.
+        """
+        target = q / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                upper = 2 ** ((bucket + 1) / self.buckets_per_octave) / 1e6
+                return min(upper, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "total_s": self.total,
+            "mean_ms": 1e3 * self.total / self.count,
+            "min_ms": 1e3 * self.min,
+            "p50_ms": 1e3 * self.percentile(50),
+            "p90_ms": 1e3 * self.percentile(90),
+            "p99_ms": 1e3 * self.percentile(99),
+            "max_ms": 1e3 * self.max,
+        }
+
+
+class _Timer:
+    __slots__ = ("metrics", "stage", "items", "start")
+
+    def __init__(self, metrics, stage, items):
+        self.metrics = metrics
+        self.stage = stage
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.stage, time.perf_counter() - self.start, self.items)
+        return False
+
+
+class _NoOpTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_OP_TIMER = _NoOpTimer()
+
+
+class Metrics:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.histograms = defaultdict(Histogram)
+        # Number of items (rows, simulations, samples) processed by each stage, for throughput.
+        self.items = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    def timer(self, stage, items=0):
+        """
+        Time a block of code as one occurrence of a stage.
+        :param stage: The name of the stage.
+        :param items: Number of items processed by the block, used to report the stage's throughput.
+        """
+        if not self.enabled:
+            return _NO_OP_TIMER
+        return _Timer(self, stage, items)
+
+    def record(self, stage, seconds, items=0):
+        if not self.enabled:
+            return
+        self.histograms[stage].add(seconds)
+        self.items[stage] += items
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] += value
+
+    def snapshot(self):
+        """
+        :return: A picklable copy of the metrics, i.e. to send from a worker process to the parent.
+        """
+        return {
+            "histograms": dict(self.histograms),
+            "items": dict(self.items),
+            "counters": dict(self.counters),
+        }
+
+    def pop_snapshot(self):
+        snapshot = self.snapshot()
+        self.reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        for stage, histogram in snapshot["histograms"].items():
+            self.histograms[stage].merge(histogram)
+        for stage, items in snapshot["items"].items():
+            self.items[stage] += items
+        for name, value in snapshot["counters"].items():
+            self.counters[name] += value
+
+    def reset(self):
+        self.histograms.clear()
+        self.items.clear()
+        self.counters.clear()
+
+    def summary(self):
+        stages = {}
+        for stage, histogram in self.histograms.items():
+            stages[stage] = histogram.summary()
+            if self.items.get(stage):
+                stages[stage]["items"] = self.items[stage]
+                stages[stage]["items_per_sec"] = self.items[stage] / histogram.total
+        return {"stages": stages, "counters": dict(self.counters)}
+
+    def report(self, logger, label, reset=True):
+        """
+        Log a summary of the metrics, and append it as a JSON line to Config.metrics_file if one is set.
+        :param logger: The logger of the calling module.
+        :param label: A name for the part of the pipeline being reported, i.e. "training".
+        :param reset: If True, start collecting from scratch afterwards.
+        """
+        if not self.enabled or not self.histograms:
+            return
+        summary = {"label": label, "timestamp": time.time(), "pid": os.getpid()}
+        summary.update(self.summary())
+        lines = [f"Metrics for {label}:"]
+        for stage, stats in sorted(summary["stages"].items()):
+            line = (
+                f"{stage}: {stats['count']} calls, {stats['total_s']:.3f}s total, "
+                f"p50 {stats['p50_ms']:.3f}ms, p99 {stats['p99_ms']:.3f}ms"
+            )
+            if "items_per_sec" in stats:
+                line += f", {stats['items_per_sec']:.1f} items/s"
+            lines.append(line)
+        logger.info("\n ".join(lines))
+
+        metrics_file = Config().metrics_file
+        if metrics_file:
+            if os.path.dirname(metrics_file):
+                os.makedirs(os.path.dirname(metrics_file), exist_ok=True)
+            with open(metrics_file, "a") as f:
+                f.write(json.dumps(summary) + "\n")
+        if reset:
+            self.reset()
+
+
+metrics = Metrics(enabled=Config().instrumentation)
+
+
+@contextmanager
+def profile(name):
+    """
+    Profile a block of code with the profiler set in Config.profiler ("cprofile" or "pyinstrument").
+    The result is written to Config.profile_dir. Does nothing if no profiler is set.
+    :param name: Used in the name of the output file.
+    """
+    config = Config()
+    profiler = config.profiler
+    if not profiler:
+        yield
+        return
+
+    os.makedirs(config.profile_dir, exist_ok=True)
+    path = os.path.join(config.profile_dir, f"{name}_{os.getpid()}_{int(time.time())}")
+    if profiler == "cprofile":
+        cprofile = cProfile.Profile()
+        cprofile.enable()
+        try:
+            yield
+        finally:
+            cprofile.disable()
+            cprofile.dump_stats(f"{path}.prof")
+    elif profiler == "pyinstrument":
+        # Optional dependency.
+        from pyinstrument import Profiler
+
+        pyinstrument_profiler = Profiler()
+        pyinstrument_profiler.start()
+        try:
+            yield
+        finally:
+            pyinstrument_profiler.stop()
+            with open(f"{path}.html", "w") as f:
+                f.write(pyinstrument_profiler.output_html())
+    else:
+        raise RuntimeError(f"The following profiler is not recognized: {profiler}")
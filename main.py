@@ -1,5 +1,6 @@
 # Local module imports
 from clean_data import DataCleaner
+from config import Config
 from ml_workflow import MLWorkflow
 from training_data_generator import TrainingDataGenerator
 
@@ -12,7 +13,9 @@ def generate_training_data():
     data_cleaner = DataCleaner()
     training_data, normalized_training_data = data_cleaner.data_cleaning_pipeline()
     training_data_generator = TrainingDataGenerator(
-        season_stats=training_data, normalized_season_stats=normalized_training_data
+        season_stats=training_data,
+        normalized_season_stats=normalized_training_data,
+        player_registry=data_cleaner.player_registry,
     )
     training_data_generator.generate_training_data()
 
@@ -22,7 +25,17 @@ def train_model():
     Call this method in __main__ to perform model training.
     :return:
     """
-    ml_workflow = MLWorkflow()
+    if Config().online_training:
+        # Online training simulates the leagues itself, so it needs the cleaned season data.
+        data_cleaner = DataCleaner()
+        training_data, normalized_training_data = data_cleaner.data_cleaning_pipeline()
+        ml_workflow = MLWorkflow(
+            season_stats=training_data,
+            normalized_season_stats=normalized_training_data,
+            player_registry=data_cleaner.player_registry,
+        )
+    else:
+        ml_workflow = MLWorkflow()
     ml_workflow.train_model()
     pass
 
@@ -3,9 +3,13 @@ This module is designed to run the entire ML workflow for the project.
 """
 
 from glob import glob
+import math
 import os
+import random
+import time
 import numpy as np
 import pandas as pd
+import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import DataLoader, Dataset
@@ -25,13 +29,39 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 from config import Config
-from nnmodeldataset import NNModelDataSet
-from model import FeedforwardNeuralNetModel
+from instrumentation import metrics, profile
+from storage import find_manifests, read_manifests
+from nnmodeldataset import BatchLoader, MemmapDataSet, NNModelDataSet, SimulationDataSet
+from training_data_generator import TrainingDataGenerator
+from model import (
+    EnsembleFeedforwardModel,
+    FeedforwardNeuralNetModel,
+    compile_model,
+    save_model_artifact,
+)
 
 
 class MLWorkflow:
-    def __init__(self):
-        self.config = Config()
+    def __init__(
+        self,
+        season_stats=None,
+        normalized_season_stats=None,
+        player_registry=None,
+        config=None,
+    ):
+        """
+        Constructor.
+        The season data is only needed for online training (Config.online_training), which simulates the
+        training data instead of reading it. Otherwise, the data is read from the generated files.
+        :param season_stats: A dictionary with years as keys, and dictionaries of player stats as values.
+        :param normalized_season_stats: The same for the normalized stats.
+        :param player_registry: Optional PlayerRegistry of the seasons.
+        :param config: Optional Config, i.e. with overrides for a model variant. Defaults to Config().
+        """
+        self.config = config or Config()
+        self.season_stats = season_stats
+        self.normalized_season_stats = normalized_season_stats
+        self.player_registry = player_registry
         self.training_data = None
         self.test_data = None
         self.validation_data = None
@@ -39,44 +69,43 @@ class MLWorkflow:
         self.optimizer = None
         self.criterion = None
 
-    def read_in_data(self):
-        training_dir = "training_data"
-        test_dir = "test_data"
-        validation_data = "validation_data"
+    def read_split(self, data_dir):
+        """
+        Read every data file of a split (training, test or validation) into a DataFrame.
+        The manifests of the data directories give the row counts, so the data is read straight into one
+        preallocated float32 array. Directories without a manifest are read as legacy CSV files.
+        :param data_dir: The root directory of the split.
+        :return: A DataFrame with the data columns.
+        """
+        manifests = find_manifests(data_dir)
+        if manifests:
+            data = read_manifests(manifests, columns=self.config.data_columns)
+            return pd.DataFrame(data, columns=self.config.data_columns, copy=False)
 
-        training_files = [
-            y for x in os.walk(training_dir) for y in glob(os.path.join(x[0], "*.csv"))
+        files = [
+            y for x in os.walk(data_dir) for y in glob(os.path.join(x[0], "*.csv"))
         ]
-        test_files = [
-            y for x in os.walk(test_dir) for y in glob(os.path.join(x[0], "*.csv"))
-        ]
-        validation_files = [
-            y
-            for x in os.walk(validation_data)
-            for y in glob(os.path.join(x[0], "*.csv"))
-        ]
-
-        training_dfs = [pd.read_csv(file, index_col=0) for file in training_files]
-        test_dfs = [pd.read_csv(file, index_col=0) for file in test_files]
-        validation_dfs = [pd.read_csv(file, index_col=0) for file in validation_files]
+        data = pd.concat([pd.read_csv(file, index_col=0) for file in files])
+        if "sample_weight" not in data:
+            # Legacy files were generated with uniform sampling.
+            data["sample_weight"] = 1.0
+        return data
 
+    def read_in_data(self):
         logger.info("Reading training data...")
-        training_df = pd.concat(training_dfs)
+        training_df = self.read_split("training_data")
         logger.info("Reading test data...")
-        test_df = pd.concat(test_dfs)
+        test_df = self.read_split("test_data")
         logger.info("Reading validation data...")
-        validation_df = pd.concat(validation_dfs)
-
-        # Clear memory.
-        training_dfs = None
-        test_dfs = None
-        validation_dfs = None
+        validation_df = self.read_split("validation_data")
 
         if self.config.combine_data:
             combined_df = pd.concat([training_df, test_df, validation_df])
             # Shuffle the dataframe.
             length = len(combined_df)
-            combined_df = combined_df.sample(frac=1).reset_index(drop=True)
+            combined_df = combined_df.sample(
+                frac=1, random_state=self.config.random_seed
+            ).reset_index(drop=True)
             # Set 70% for training, 20% for test, 10% for validation.
             first_split = round(0.7 * length)
             second_split = round(0.9 * length)
@@ -88,18 +117,23 @@ class MLWorkflow:
         self.test_data = test_df
         self.validation_data = validation_df
 
-    def select_loss_function(self, loss_func):
+    def select_loss_function(self, loss_func, reduction="mean"):
         if loss_func == "mae":
-            return nn.L1Loss()
+            return nn.L1Loss(reduction=reduction)
         elif loss_func == "smooth_l1":
-            return nn.SmoothL1Loss()
+            return nn.SmoothL1Loss(reduction=reduction)
         else:
             # By default, use Mean Squared Error loss function.
-            return nn.MSELoss()
+            return nn.MSELoss(reduction=reduction)
 
     def select_optimizer(self, optimizer, model_params, learning_rate, weight_decay):
         if optimizer == "adam":
             return optim.Adam(model_params, lr=learning_rate, weight_decay=weight_decay)
+        elif optimizer == "adamw":
+            # Decoupled weight decay, which does not shrink with the adaptive step sizes of large batches.
+            return optim.AdamW(
+                model_params, lr=learning_rate, weight_decay=weight_decay
+            )
         elif optimizer == "sgd" or optimizer == "sgd_m":
             momentum = 0 if optimizer == "sgd" else 0.9
             return optim.SGD(
@@ -117,15 +151,139 @@ class MLWorkflow:
                 f"The following optimizer is not recognized: {optimizer}"
             )
 
-    def train_model(self):
+    def scaled_learning_rate(self):
+        """
+        Scale Config.learning_rate from Config.base_batch_size to the effective batch size, which is the batch
+        size times the gradient accumulation steps. Linear scaling keeps the update per sample constant, sqrt
+        scaling keeps the variance of the updates constant, which suits adaptive optimizers such as Adam.
+        :return: The learning rate.
+        """
+        learning_rate = self.config.learning_rate
+        ratio = (
+            self.config.batch_size
+            * self.config.gradient_accumulation_steps
+            / self.config.base_batch_size
+        )
+        if self.config.lr_scaling is None:
+            return learning_rate
+        elif self.config.lr_scaling == "linear":
+            return learning_rate * ratio
+        elif self.config.lr_scaling == "sqrt":
+            return learning_rate * math.sqrt(ratio)
+        else:
+            raise RuntimeError(
+                f"The following learning rate scaling is not recognized: {self.config.lr_scaling}"
+            )
+
+    def select_lr_scheduler(self, optimizer, warmup_steps):
+        """
+        :param warmup_steps: Number of optimizer steps over which the learning rate rises linearly to its value.
+        :return: A scheduler stepped after every optimizer step, or None without warmup.
+        """
+        if not warmup_steps:
+            return None
+        return optim.lr_scheduler.LambdaLR(
+            optimizer, lambda step: min(1.0, (step + 1) / warmup_steps)
+        )
+
+    def select_data_loader(self, data_loader, dataset, shuffle=True):
+        if isinstance(dataset, SimulationDataSet):
+            # The dataset yields whole batches in random order. Persistent worker processes simulate them ahead
+            # of the trainer, up to prefetch_factor batches each.
+            num_workers = self.config.num_workers if self.config.num_workers > 1 else 0
+            return DataLoader(
+                dataset,
+                batch_size=None,
+                num_workers=num_workers,
+                persistent_workers=num_workers > 0,
+                prefetch_factor=(
+                    (self.config.prefetch_batches or 2) if num_workers else None
+                ),
+            )
+        if data_loader == "batch":
+            return BatchLoader(
+                dataset,
+                batch_size=self.config.batch_size,
+                shuffle=shuffle,
+                prefetch_batches=self.config.prefetch_batches,
+            )
+        elif data_loader == "torch":
+            return DataLoader(
+                dataset, batch_size=self.config.batch_size, shuffle=shuffle
+            )
+        else:
+            raise RuntimeError(
+                f"The following data loader is not recognized: {data_loader}"
+            )
+
+    def simulate_datasets(self):
+        """
+        Build the datasets of online training. The training years are simulated on the fly by a
+        SimulationDataSet. The test and validation years are simulated once, from the same seeds as their
+        generated files, so they stay fixed across epochs and runs.
+        :return: A tuple (train_data, test_data, validation_data).
+        """
+        if self.season_stats is None:
+            raise RuntimeError("Online training needs the season data.")
+        if self.config.combine_data:
+            raise RuntimeError("combine_data is not supported with online_training.")
+        generator = TrainingDataGenerator(
+            season_stats=self.season_stats,
+            normalized_season_stats=self.normalized_season_stats,
+            player_registry=self.player_registry,
+        )
+        train_data = SimulationDataSet(
+            generator,
+            seasons=self.config.training_years,
+            rows_per_epoch=self.config.online_rows_per_epoch,
+            batch_size=self.config.batch_size,
+        )
+        held_out_data = []
+        for years in [self.config.test_years, self.config.validation_years]:
+            rows = np.concatenate([generator.simulate_season(year) for year in years])
+            held_out_data.append(
+                NNModelDataSet(X=rows[:, :-2], y=rows[:, -2], weights=rows[:, -1])
+            )
+        test_data, validation_data = held_out_data
+        return train_data, test_data, validation_data
+
+    def load_datasets(self):
+        """
+        Load the training, test and validation datasets.
+        With Config.memory_map_data, the .npy files listed in the manifests are memory-mapped instead of read.
+        With Config.online_training, the datasets are simulated instead (see simulate_datasets).
+        :return: A tuple (train_data, test_data, validation_data).
+        """
+        if self.config.online_training:
+            return self.simulate_datasets()
+        if self.config.memory_map_data:
+            if self.config.combine_data:
+                raise RuntimeError(
+                    "combine_data is not supported with memory_map_data."
+                )
+            datasets = []
+            for data_dir in ["training_data", "test_data", "validation_data"]:
+                manifests = find_manifests(data_dir)
+                if not any(manifest.files for manifest in manifests):
+                    raise RuntimeError(
+                        f"No data files are listed in a manifest under {data_dir}. Generate the data, or disable "
+                        "memory_map_data to read legacy CSV files."
+                    )
+                datasets.append(MemmapDataSet.from_manifests(manifests))
+            return tuple(datasets)
+
         self.read_in_data()
         label = "total_fantasy_pts"
-        X_train = self.training_data.drop(columns=[label]).to_numpy()
+        weight = "sample_weight"
+        X_train = self.training_data.drop(columns=[label, weight]).to_numpy()
         y_train = self.training_data[label].to_numpy()
-        X_test = self.test_data.drop(columns=[label]).to_numpy()
+        w_train = self.training_data[weight].to_numpy()
+        X_test = self.test_data.drop(columns=[label, weight]).to_numpy()
         y_test = self.test_data[label].to_numpy()
-        X_val = self.validation_data.drop(columns=[label]).to_numpy()
+        w_test = self.test_data[weight].to_numpy()
+        X_val = self.validation_data.drop(columns=[label, weight]).to_numpy()
         y_val = self.validation_data[label].to_numpy()
+        w_val = self.validation_data[weight].to_numpy()
 
         """
         NOTE: we don't want to normalize the data again! 
@@ -133,55 +291,363 @@ class MLWorkflow:
         If we normalized the features again, we would be comparing different seasons to each other.
         """
 
-        input_dim = len(X_test[0])  # Number of features.
+        train_data = NNModelDataSet(X=X_train, y=y_train, weights=w_train)
+        test_data = NNModelDataSet(X=X_test, y=y_test, weights=w_test)
+        validation_data = NNModelDataSet(X=X_val, y=y_val, weights=w_val)
+        return train_data, test_data, validation_data
 
-        train_data = NNModelDataSet(X=X_train, y=y_train)
-        test_data = NNModelDataSet(X=X_test, y=y_test)
-        validation_data = NNModelDataSet(X=X_val, y=y_val)
+    def train_model(self):
+        self.configure_threads()
+        with metrics.timer("data_read"):
+            train_data, test_data, validation_data = self.load_datasets()
 
-        train_data_loader = DataLoader(
-            train_data, batch_size=self.config.batch_size, shuffle=True
-        )
+        state = None
+        if self.config.resume_training:
+            state = self.read_checkpoint(self.config.checkpoint_path)
 
-        self.model = FeedforwardNeuralNetModel(input_dim=input_dim)
-        model_parameters = self.model.parameters()
+        # Train the model.
+        logger.info("Beginning Model Training...")
+        with profile("training"):
+            self.fit(train_data, validation_data, state=state)
+        metrics.report(logger, label="training")
 
-        # Set the loss function.
-        self.criterion = self.select_loss_function(loss_func=self.config.loss_function)
+        self.restore_best_model()
+        save_model_artifact(self.model, self.config.model_path)
+        logger.info(f"Saved model to {self.config.model_path}.")
+        logger.info(f"Test Loss: {self.evaluate(test_data)}")
+
+    def configure_threads(self):
+        """
+        Apply the thread settings of the config (Config.num_threads and Config.num_interop_threads).
+        """
+        if self.config.num_threads:
+            torch.set_num_threads(self.config.num_threads)
+        num_interop_threads = self.config.num_interop_threads
+        if (
+            num_interop_threads
+            and num_interop_threads != torch.get_num_interop_threads()
+        ):
+            try:
+                torch.set_num_interop_threads(num_interop_threads)
+            except RuntimeError:
+                # PyTorch only allows it before the first parallel work of the process.
+                logger.info(
+                    "The number of inter-op threads can only be set before any parallel work, keeping "
+                    f"{torch.get_num_interop_threads()}."
+                )
+
+    def build_model(self, input_dim):
+        """
+        Create the model, loss function and optimizer from the config.
+        With Config.ensemble_size above 1, the model is an EnsembleFeedforwardModel.
+        """
+        architecture = {
+            "input_dim": input_dim,
+            "hidden_layer_sizes": self.config.hidden_layer_sizes,
+            "activation": self.config.activation,
+            "dropout": self.config.dropout,
+        }
+        if self.config.ensemble_size > 1:
+            self.model = EnsembleFeedforwardModel(
+                num_models=self.config.ensemble_size, **architecture
+            )
+        else:
+            self.model = FeedforwardNeuralNetModel(**architecture)
+        # The model that runs the forward passes. It shares its parameters with self.model.
+        self.forward_model = compile_model(self.model, self.config.compile_mode)
+
+        # Set the loss function. It returns the loss of every sample, which is then weighted and averaged.
+        self.criterion = self.select_loss_function(
+            loss_func=self.config.loss_function, reduction="none"
+        )
 
         # Select the optimizer.
         self.optimizer = self.select_optimizer(
             optimizer=self.config.optimizer,
-            model_params=model_parameters,
-            learning_rate=self.config.learning_rate,
+            model_params=self.model.parameters(),
+            learning_rate=self.scaled_learning_rate(),
             weight_decay=self.config.weight_decay,
         )
+        self.lr_scheduler = self.select_lr_scheduler(
+            self.optimizer, self.config.warmup_steps
+        )
 
-        # Train the model.
-        logger.info("Beginning Model Training...")
-        for epoch in range(self.config.epochs):
-
-            epoch_loss = None
+    def fit(self, train_data, validation_data, state=None, stop_epoch=None):
+        """
+        Build a model and train it with early stopping on the validation loss.
+        The model is left as it is after the last epoch; restore_best_model loads the best weights.
+        :param train_data: The training dataset.
+        :param validation_data: The validation dataset.
+        :param state: Optional trainer state (see trainer_state) to resume training from.
+        :param stop_epoch: Optional number of epochs after which to stop. Defaults to Config.epochs.
+        :return: A dictionary with the keys being:
+            - 'best_loss' - the lowest validation loss, or None without validation data.
+            - 'epochs' - the number of epochs trained, including the epochs of the resumed state.
+            - 'stopped_early' - True if training stopped because the validation loss stopped improving.
+        """
+        train_data_loader = self.select_data_loader(
+            data_loader=self.config.data_loader, dataset=train_data
+        )
+        self.build_model(input_dim=train_data.input_size)
+
+        # Early stopping state.
+        self.start_epoch = 0
+        self.best_loss = math.inf
+        self.best_state_dict = None
+        self.epochs_without_improvement = 0
+        if state is not None:
+            self.load_trainer_state(state)
+        if isinstance(train_data, SimulationDataSet):
+            # Continue with fresh leagues rather than the ones of the first epochs.
+            train_data.epoch = self.start_epoch
+
+        patience = self.config.early_stopping_patience
+        stop_epoch = self.config.epochs if stop_epoch is None else stop_epoch
+        epochs = self.start_epoch
+        stopped_early = False
+        for epoch in range(self.start_epoch, stop_epoch):
+            self.train_epoch(epoch, train_data_loader)
+            with metrics.timer("validation", items=len(validation_data)):
+                validation_loss = self.evaluate(validation_data)
+            self.end_epoch(epoch, validation_loss)
+            epochs = epoch + 1
+            if patience is not None and self.epochs_without_improvement >= patience:
+                logger.info(
+                    f"Stopping early after epoch {epoch+1}: the validation loss has not improved in "
+                    f"{patience} epochs. Best validation loss: {self.best_loss}"
+                )
+                stopped_early = True
+                break
+        return {
+            "best_loss": None if self.best_state_dict is None else self.best_loss,
+            "epochs": epochs,
+            "stopped_early": stopped_early,
+        }
+
+    def restore_best_model(self):
+        """
+        Load the weights of the epoch with the lowest validation loss into the model.
+        """
+        if self.best_state_dict is not None:
+            self.model.load_state_dict(self.best_state_dict)
 
-            for i, (data, labels) in enumerate(train_data_loader):
+    def end_epoch(self, epoch, validation_loss):
+        """
+        Track the best model by validation loss, and checkpoint the trainer state.
+        """
+        if validation_loss is not None:
+            logger.info(
+                f"Validation Loss on Epoch {epoch+1}/{self.config.epochs}: {validation_loss}"
+            )
+            if validation_loss < self.best_loss - self.config.early_stopping_min_delta:
+                self.best_loss = validation_loss
+                self.best_state_dict = {
+                    name: tensor.detach().clone()
+                    for name, tensor in self.model.state_dict().items()
+                }
+                self.epochs_without_improvement = 0
+                save_model_artifact(self.model, self.config.model_path)
+            else:
+                self.epochs_without_improvement += 1
+        if self.config.checkpoint_path:
+            self.save_checkpoint(self.config.checkpoint_path, epoch)
+
+    def trainer_state(self, epoch):
+        """
+        :return: A dictionary with everything needed to resume training after the epoch.
+        """
+        return {
+            "epoch": epoch,
+            "model": self.model.state_dict(),
+            "architecture": self.model.architecture(),
+            "optimizer": self.optimizer.state_dict(),
+            "lr_scheduler": (
+                None if self.lr_scheduler is None else self.lr_scheduler.state_dict()
+            ),
+            "best_loss": self.best_loss,
+            "best_state_dict": self.best_state_dict,
+            "epochs_without_improvement": self.epochs_without_improvement,
+            "torch_rng_state": torch.get_rng_state(),
+            "numpy_rng_state": np.random.get_state(),
+            "python_rng_state": random.getstate(),
+        }
+
+    def load_trainer_state(self, state):
+        """
+        Restore a state returned by trainer_state into the model built by build_model.
+        """
+        if state["architecture"] != self.model.architecture():
+            raise RuntimeError(
+                "The trainer state was saved from a different architecture."
+            )
+        self.model.load_state_dict(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        if self.lr_scheduler is not None and state.get("lr_scheduler") is not None:
+            self.lr_scheduler.load_state_dict(state["lr_scheduler"])
+        self.start_epoch = state["epoch"] + 1
+        self.best_loss = state["best_loss"]
+        self.best_state_dict = state["best_state_dict"]
+        self.epochs_without_improvement = state["epochs_without_improvement"]
+        torch.set_rng_state(state["torch_rng_state"])
+        np.random.set_state(state["numpy_rng_state"])
+        random.setstate(state["python_rng_state"])
+
+    def save_checkpoint(self, path, epoch):
+        """
+        Save the trainer state after the epoch.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        torch.save(self.trainer_state(epoch), tmp_path)
+        os.replace(tmp_path, path)
 
-                # Clear gradients with respect to parameters.
-                self.optimizer.zero_grad()
+    def read_checkpoint(self, path):
+        """
+        Read the trainer state saved by save_checkpoint.
+        :return: The state, or None if there is no checkpoint.
+        """
+        if not path or not os.path.exists(path):
+            logger.info("No checkpoint to resume from, training from scratch.")
+            return None
+        # The checkpoint holds RNG states, which are not plain tensors.
+        state = torch.load(path, map_location="cpu", weights_only=False)
+        logger.info(f"Resuming training from epoch {state['epoch']+2}.")
+        return state
+
+    @staticmethod
+    def weighted_mean(losses, weights):
+        """
+        :param losses: A (batch, 1) tensor of per-sample losses, or (num_models, batch, 1) for an ensemble.
+        :param weights: A (batch, 1) tensor of sample weights, or None for equal weights.
+        :return: The mean loss, of shape () or (num_models,) for an ensemble.
+        """
+        if weights is None:
+            return losses.mean(dim=(-2, -1))
+        return (losses * weights).sum(dim=(-2, -1)) / weights.sum()
 
-                # Forward Feed
-                outputs = self.model(data)
+    def compute_loss(self, outputs, labels, weights):
+        """
+        :return: The weighted mean loss of the model outputs, of shape () or (num_models,) for an ensemble.
+        """
+        # The models of an ensemble share the labels.
+        losses = self.criterion(outputs, labels.expand_as(outputs))
+        return self.weighted_mean(losses, weights)
 
-                # Calculate Loss
-                loss = self.criterion(outputs, labels)
-                epoch_loss = loss
+    def evaluate(self, dataset, batch_size=65536):
+        """
+        Compute the loss over a whole dataset, in large vectorized batches. Only one batch is gathered at a time,
+        so memory-mapped datasets are never read into memory as a whole.
+        :param batch_size: Number of rows per forward pass.
+        :return: The weighted mean loss, averaged over the models of an ensemble, or None if the dataset is empty.
+        """
+        if len(dataset) == 0:
+            return None
+        # Sums of the batch losses times the batch weights, and of the batch weights.
+        loss_sum = torch.zeros(())
+        weight_sum = torch.zeros(())
+        self.forward_model.eval()
+        with torch.no_grad():
+            for start in range(0, len(dataset), batch_size):
+                batch = dataset.get_batch(
+                    slice(start, min(start + batch_size, len(dataset)))
+                )
+                data, labels = batch[0], batch[1]
+                weights = batch[2] if len(batch) > 2 else None
+                loss = self.compute_loss(self.forward_model(data), labels, weights)
+                batch_weight = len(data) if weights is None else weights.sum()
+                loss_sum = loss_sum + loss.mean() * batch_weight
+                weight_sum += batch_weight
+        self.forward_model.train()
+        return (loss_sum / weight_sum).item()
+
+    def optimizer_step(self, num_batches):
+        """
+        Update the parameters with the gradients accumulated over num_batches batches, and clear them.
+        """
+        accumulation_steps = self.config.gradient_accumulation_steps
+        if num_batches < accumulation_steps:
+            # The last step of an epoch can have fewer batches, so rescale their gradients to a mean.
+            for parameter in self.model.parameters():
+                if parameter.grad is not None:
+                    parameter.grad.mul_(accumulation_steps / num_batches)
+        self.optimizer.step()
+        if self.lr_scheduler is not None:
+            self.lr_scheduler.step()
+        # Clear gradients with respect to parameters.
+        self.optimizer.zero_grad()
+
+    def train_epoch(self, epoch, train_data_loader):
+        """
+        Train the model for one epoch.
+        With Config.gradient_accumulation_steps above 1, the parameters are updated with the mean gradient of
+        that many batches. With Config.autocast_dtype, the forward pass runs in that precision.
+        :return: The mean training loss over the epoch, weighted like the batches.
+        """
+        epoch_start = time.perf_counter()
+        # Sums of the batch losses times the batch weights, and of the batch weights.
+        loss_sum = torch.zeros(())
+        weight_sum = torch.zeros(())
+        num_samples = 0
+        accumulation_steps = self.config.gradient_accumulation_steps
+        # Batches whose gradients were accumulated since the last optimizer step.
+        num_batches = 0
+        autocast_dtype = (
+            getattr(torch, self.config.autocast_dtype)
+            if self.config.autocast_dtype
+            else None
+        )
 
+        self.forward_model.train()
+        self.optimizer.zero_grad()
+        batches = iter(train_data_loader)
+        while True:
+            with metrics.timer("data_loader"):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            data, labels = batch[0], batch[1]
+            # Datasets without sample weights give every sample the same weight.
+            weights = batch[2] if len(batch) > 2 else None
+            num_samples += len(data)
+
+            with metrics.timer("forward", items=len(data)):
+                # Forward Feed
+                with torch.autocast(
+                    "cpu",
+                    dtype=autocast_dtype,
+                    enabled=autocast_dtype is not None,
+                ):
+                    outputs = self.forward_model(data)
+
+                # Calculate Loss, in float32. The models of an ensemble have separate weights, so
+                # backpropagating the sum of their losses gives every model the gradient of its own loss.
+                losses = self.compute_loss(outputs.float(), labels, weights)
+                loss = losses.mean()
+
+            with metrics.timer("backward", items=len(data)):
                 # Get gradients with respect to parameters.
-                loss.backward()
-
-                # Update parameters.
-                self.optimizer.step()
-
-            loss_value = epoch_loss.item()
-            logger.info(
-                f"Training Loss on Epoch {epoch+1}/{self.config.epochs}: {loss_value}"
-            )
+                (losses.sum() / accumulation_steps).backward()
+            num_batches += 1
+
+            if num_batches == accumulation_steps:
+                with metrics.timer("optimizer_step", items=len(data)):
+                    # Update parameters.
+                    self.optimizer_step(num_batches)
+                num_batches = 0
+
+            batch_weight = len(data) if weights is None else weights.sum()
+            loss_sum += loss.detach() * batch_weight
+            weight_sum += batch_weight
+
+        if num_batches:
+            self.optimizer_step(num_batches)
+
+        epoch_time = time.perf_counter() - epoch_start
+        metrics.record("epoch", epoch_time, items=num_samples)
+        loss_value = (loss_sum / weight_sum).item()
+        logger.info(
+            f"Training Loss on Epoch {epoch+1}/{self.config.epochs}: {loss_value} "
+            f"({epoch_time:.2f}s, {num_samples / epoch_time:.0f} samples/s)"
+        )
+        return loss_value
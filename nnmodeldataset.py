@@ -1,28 +1,293 @@
 """
 A class to encapsulate a dataset.
 """
-import torch
+import bisect
+import queue
+import threading
 
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
 
-class NNModelDataSet:
-    def __init__(self, X, y):
-        if y is None:
-            # This occurs during prediction.
-            self.data = torch.tensor(X).float()
+from storage import NpyStorage
+from training_data_generator import simulate_league_rows
 
-        else:
-            self.data = X.tolist()
-            self.labels = y.tolist()
 
-            self.data = torch.tensor(self.data).float()
-            self.labels = torch.tensor(self.labels).float().view(-1, 1)
+class NNModelDataSet:
+    def __init__(self, X, y, weights=None):
+        # torch.from_numpy shares memory with the arrays, so no intermediate copies are made.
+        self.data = torch.from_numpy(np.ascontiguousarray(X, dtype=np.float32))
+        if y is not None:
+            # y is None during prediction.
+            self.labels = torch.from_numpy(
+                np.ascontiguousarray(y, dtype=np.float32)
+            ).view(-1, 1)
+        # Optional sample weights. Datasets with weights return (data, labels, weights) tuples.
+        self.weights = None
+        if weights is not None:
+            self.weights = torch.from_numpy(
+                np.ascontiguousarray(weights, dtype=np.float32)
+            ).view(-1, 1)
 
         self.input_size = self.data.shape[-1]
 
     def __getitem__(self, index):
         data = self.data[index]
         labels = self.labels[index]
+        if self.weights is not None:
+            return data, labels, self.weights[index]
         return data, labels
 
     def __len__(self):
         return len(self.labels)
+
+    def get_batch(self, indices):
+        """
+        :param indices: A slice or a tensor of row indices.
+        :return: A tuple (data, labels), or (data, labels, weights) with sample weights.
+            Slices return views of the resident tensors.
+        """
+        if self.weights is not None:
+            return self.data[indices], self.labels[indices], self.weights[indices]
+        return self.data[indices], self.labels[indices]
+
+
+class MemmapDataSet:
+    """
+    A dataset over .npy files that are memory-mapped rather than read into memory.
+    Each file holds the features followed by the label, and with weighted=True by the sample weight.
+    Pages are only loaded when rows are accessed, so the dataset can be larger than RAM.
+    """
+
+    def __init__(self, paths, weighted=False):
+        storage = NpyStorage()
+        self.weighted = weighted
+        num_features = -2 if weighted else -1
+        self.data = []
+        self.labels = []
+        self.weights = []
+        self.offsets = [0]
+        for path in paths:
+            # Copy-on-write mapping: writable from torch's point of view, but never written back to disk.
+            values = storage.read(path, mmap_mode="c")
+            self.data.append(torch.from_numpy(values[:, :num_features]))
+            self.labels.append(
+                torch.from_numpy(values[:, num_features : num_features + 1])
+            )
+            if weighted:
+                self.weights.append(torch.from_numpy(values[:, -1:]))
+            self.offsets.append(self.offsets[-1] + len(values))
+
+        self.input_size = self.data[0].shape[-1] if self.data else 0
+
+    @classmethod
+    def from_manifests(cls, manifests):
+        paths = [path for manifest in manifests for path in manifest.file_paths()]
+        for path in paths:
+            if not path.endswith(NpyStorage.extension):
+                raise RuntimeError(f"Only .npy files can be memory-mapped: {path}")
+        weighted = any("sample_weight" in manifest.columns for manifest in manifests)
+        return cls(paths, weighted=weighted)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        file_index = bisect.bisect_right(self.offsets, index) - 1
+        row = index - self.offsets[file_index]
+        if self.weighted:
+            return (
+                self.data[file_index][row],
+                self.labels[file_index][row],
+                self.weights[file_index][row],
+            )
+        return self.data[file_index][row], self.labels[file_index][row]
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def get_batch(self, indices):
+        """
+        :param indices: A slice or a tensor of row indices.
+        :return: A tuple (data, labels), or (data, labels, weights) if weighted, gathered from the
+            memory-mapped files.
+        """
+        if isinstance(indices, slice):
+            indices = torch.arange(*indices.indices(len(self)))
+        if len(self.data) == 1:
+            if self.weighted:
+                return (
+                    self.data[0][indices],
+                    self.labels[0][indices],
+                    self.weights[0][indices],
+                )
+            return self.data[0][indices], self.labels[0][indices]
+
+        file_indices = torch.searchsorted(
+            torch.tensor(self.offsets[1:]), indices, right=True
+        )
+        data = torch.empty((len(indices), self.input_size), dtype=torch.float32)
+        labels = torch.empty((len(indices), 1), dtype=torch.float32)
+        weights = torch.empty((len(indices), 1), dtype=torch.float32)
+        for file_index in torch.unique(file_indices).tolist():
+            mask = file_indices == file_index
+            rows = indices[mask] - self.offsets[file_index]
+            data[mask] = self.data[file_index][rows]
+            labels[mask] = self.labels[file_index][rows]
+            if self.weighted:
+                weights[mask] = self.weights[file_index][rows]
+        if self.weighted:
+            return data, labels, weights
+        return data, labels
+
+
+class SimulationDataSet(IterableDataset):
+    """
+    Training data simulated on the fly. Every epoch simulates fresh leagues of the given seasons and yields
+    rows_per_epoch rows, so nothing is written to or read from disk.
+    Each item is a whole batch (data, labels, weights), so use it with DataLoader(batch_size=None).
+    With DataLoader workers, each worker simulates its share of the epoch from its own RNG stream, and the
+    DataLoader's bounded prefetch queue hands the batches to the trainer. Every iteration starts a new epoch,
+    so the workers must be persistent to keep their epoch counters.
+    """
+
+    def __init__(self, generator, seasons, rows_per_epoch, batch_size):
+        """
+        :param generator: A TrainingDataGenerator holding the season data.
+        :param seasons: The seasons to simulate.
+        :param rows_per_epoch: Number of rows (teams) per epoch.
+        :param batch_size: Number of rows per batch.
+        """
+        self.generator = generator
+        self.seasons = list(seasons)
+        self.rows_per_epoch = rows_per_epoch
+        self.batch_size = batch_size
+        self.epoch = 0
+        self.input_size = len(generator.config.feature_columns)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (
+            (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        )
+        num_rows = self.rows_per_epoch // num_workers + (
+            worker_id < self.rows_per_epoch % num_workers
+        )
+        rng = np.random.default_rng(
+            self.generator.online_seed_sequence(self.epoch, worker_id, num_workers)
+        )
+        self.epoch += 1
+        roto_calculators = {
+            season: self.generator.roto_calculator(season, rng)
+            for season in self.seasons
+        }
+        registry = self.generator.player_registry
+        leagues_per_season = self.generator.config.simulation_batch_size
+
+        while num_rows > 0:
+            # Simulate a chunk of leagues from every season, and shuffle the rows so batches mix seasons.
+            chunk = np.concatenate(
+                [
+                    simulate_league_rows(
+                        roto_calculators[season],
+                        registry.prev_season_features(season),
+                        leagues_per_season,
+                    )
+                    for season in self.seasons
+                ]
+            )
+            chunk = chunk[rng.permutation(len(chunk))[:num_rows]]
+            num_rows -= len(chunk)
+            chunk = torch.from_numpy(chunk.astype(np.float32))
+            for start in range(0, len(chunk), self.batch_size):
+                batch = chunk[start : start + self.batch_size]
+                yield batch[:, :-2], batch[:, -2:-1], batch[:, -1:]
+
+
+class BatchLoader:
+    """
+    A replacement for DataLoader over datasets that implement get_batch.
+    Instead of fetching and collating every sample, an epoch shuffles by permuting the row indices and gathers
+    each batch from the dataset's tensors in a single indexing operation.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        batch_size,
+        shuffle=True,
+        pin_memory=False,
+        prefetch_batches=0,
+        generator=None,
+    ):
+        """
+        :param dataset: A NNModelDataSet or MemmapDataSet.
+        :param batch_size: Number of rows per batch.
+        :param shuffle: If True, the rows are visited in a new random order every epoch.
+        :param pin_memory: If True, batches are copied into pinned memory (only used when CUDA is available).
+        :param prefetch_batches: Number of batches prepared ahead of time by a background thread. 0 disables it.
+        :param generator: Optional torch Generator used for shuffling.
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.prefetch_batches = prefetch_batches
+        self.generator = generator
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def _batches(self):
+        num_rows = len(self.dataset)
+        order = (
+            torch.randperm(num_rows, generator=self.generator) if self.shuffle else None
+        )
+        for start in range(0, num_rows, self.batch_size):
+            stop = min(start + self.batch_size, num_rows)
+            indices = order[start:stop] if self.shuffle else slice(start, stop)
+            batch = self.dataset.get_batch(indices)
+            if self.pin_memory:
+                batch = tuple(tensor.pin_memory() for tensor in batch)
+            yield batch
+
+    def __iter__(self):
+        if not self.prefetch_batches:
+            return self._batches()
+        return self._prefetched_batches()
+
+    def _prefetched_batches(self):
+        batches = queue.Queue(maxsize=self.prefetch_batches)
+        stop = threading.Event()
+        done = object()
+        # An exception raised by the producer, re-raised in the consumer.
+        errors = []
+
+        def produce():
+            try:
+                for batch in self._batches():
+                    if stop.is_set():
+                        return
+                    batches.put(batch)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                batches.put(done)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is done:
+                    if errors:
+                        raise errors[0]
+                    return
+                yield batch
+        finally:
+            # Unblock the producer if the consumer stopped early.
+            stop.set()
+            while thread.is_alive():
+                try:
+                    batches.get_nowait()
+                except queue.Empty:
+                    thread.join(timeout=0.01)
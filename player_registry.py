@@ -0,0 +1,80 @@
+"""
+A registry of dense integer player IDs for each season.
+Player names are only needed for reporting. The simulation and feature extraction work on the IDs, which are the
+row indices of the season's stat and feature matrices.
+"""
+import numpy as np
+
+from utils import prev_season_feature_matrix
+
+
+class PlayerRegistry:
+    def __init__(self, season_stats, normalized_season_stats, feature_columns):
+        """
+        Constructor.
+        :param season_stats: A dictionary with years as keys, and dictionaries of player stats as values.
+            Player i of a season is the i-th key of its dictionary.
+        :param normalized_season_stats: The same for the normalized stats.
+        :param feature_columns: The normalized stats used as features, in order.
+        """
+        self.feature_columns = list(feature_columns)
+        self.players = {}
+        self.player_ids = {}
+        self._prev_season_features = {}
+        for season, season_data in season_stats.items():
+            self.players[season] = list(season_data)
+            self.player_ids[season] = {
+                player: player_id for player_id, player in enumerate(season_data)
+            }
+            if season - 1 in normalized_season_stats:
+                self._prev_season_features[season] = prev_season_feature_matrix(
+                    players=self.players[season],
+                    prev_season_data=normalized_season_stats[season - 1],
+                    feature_columns=feature_columns,
+                )
+
+    def num_players(self, season):
+        return len(self.players[season])
+
+    def ids(self, season, players):
+        """
+        :param players: A list of player names.
+        :return: An integer array with the players' IDs in the season.
+        """
+        player_ids = self.player_ids[season]
+        try:
+            return np.array([player_ids[player] for player in players], dtype=np.int64)
+        except KeyError as e:
+            raise LookupError(f"Player {e.args[0]} not found in season {season}.")
+
+    def names(self, season, ids):
+        """
+        :param ids: An integer array of player IDs of any shape.
+        :return: The player names, as nested lists with the same shape.
+        """
+        players = self.players[season]
+        ids = np.asarray(ids)
+        if ids.ndim == 0:
+            return players[int(ids)]
+        return [self.names(season, sub_ids) for sub_ids in ids]
+
+    def prev_season_features(self, season):
+        """
+        :return: A (num_players, num_features) array, where row i holds the normalized previous season
+            stats of player i of the season.
+        """
+        return self._prev_season_features[season]
+
+    def draft_order(self, season):
+        """
+        Estimate the average draft position of the season's players from their previous season minutes per game,
+        which is known before the season starts. Falls back to the player order (minutes played in the season)
+        if minutes are not a feature.
+        :return: An integer array of the player IDs, best first.
+        """
+        if "MP/game" not in self.feature_columns:
+            return np.arange(self.num_players(season))
+        minutes = self.prev_season_features(season)[
+            :, self.feature_columns.index("MP/game")
+        ]
+        return np.argsort(-minutes, kind="stable")
@@ -0,0 +1,129 @@
+"""
+Batched inference with a trained model.
+The predictor scores fantasy rosters: given the rosters as a matrix of player IDs and a feature matrix of the
+players' normalized stats, it builds every roster's feature vector with one gather and runs the model once per
+batch of rosters.
+With an ensemble model (Config.ensemble_size), the prediction is the mean of the models, and the variance between
+them is available as an estimate of the uncertainty.
+"""
+import numpy as np
+import torch
+
+from config import Config
+from model import load_model_artifact
+from utils import calculate_team_features
+
+
+class RosterPredictor:
+    def __init__(self, model_path=None, backend="torch", batch_size=65536):
+        """
+        Constructor.
+        :param model_path: A model saved by MLWorkflow.train_model. Defaults to Config.model_path.
+            With the onnxruntime backend, a file written by export_onnx.
+        :param backend: "torch" runs the model eagerly, "torchscript" runs a traced copy of it, "compile" runs
+            it with torch.compile and "onnxruntime" runs an exported ONNX model on the CPU (requires onnxruntime).
+        :param batch_size: Maximum number of rosters per forward pass.
+        """
+        self.config = Config()
+        self.model_path = model_path or self.config.model_path
+        self.backend = backend
+        self.batch_size = batch_size
+        self.model = None
+        self.session = None
+
+        if backend == "onnxruntime":
+            # Optional dependency.
+            import onnxruntime
+
+            self.session = onnxruntime.InferenceSession(
+                self.model_path, providers=["CPUExecutionProvider"]
+            )
+            self.input_name = self.session.get_inputs()[0].name
+            return
+
+        self.model, self.artifact = load_model_artifact(self.model_path)
+        if backend == "torchscript":
+            self.model = self.trace()
+        elif backend == "compile":
+            # The last batch is usually smaller, so the model is compiled for any batch size.
+            self.model = torch.compile(self.model, dynamic=True)
+        elif backend != "torch":
+            raise RuntimeError(f"The following backend is not recognized: {backend}")
+
+    def _example_input(self):
+        return torch.zeros((1, self.model.input_size), dtype=torch.float32)
+
+    def trace(self):
+        with torch.inference_mode(False), torch.no_grad():
+            return torch.jit.trace(self.model, self._example_input())
+
+    def export_torchscript(self, path):
+        """
+        Save the model as TorchScript, which can be loaded with torch.jit.load without this code base.
+        """
+        self.trace().save(path)
+
+    def export_onnx(self, path):
+        """
+        Save the model in the ONNX format, for the onnxruntime backend. Requires the onnx and onnxscript packages.
+        """
+        # Ensembles output the predictions of every model along the first axis.
+        rosters_axis = 1 if "num_models" in self.artifact["architecture"] else 0
+        torch.onnx.export(
+            self.model,
+            self._example_input(),
+            path,
+            input_names=["features"],
+            output_names=["total_fantasy_pts"],
+            dynamic_axes={
+                "features": {0: "rosters"},
+                "total_fantasy_pts": {rosters_axis: "rosters"},
+            },
+        )
+
+    def predict_features(self, features, return_variance=False):
+        """
+        Predict the total fantasy points of teams from their feature vectors.
+        :param features: An array of shape (num_teams, num_features).
+        :param return_variance: If True, also return the variance of the predictions of the models of an ensemble.
+        :return: A float32 array of shape (num_teams,), or with return_variance, a tuple (mean, variance) of two
+            such arrays. The variance of a single model is 0.
+        """
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        mean = np.empty(len(features), dtype=np.float32)
+        variance = np.empty(len(features), dtype=np.float32)
+        for start in range(0, len(features), self.batch_size):
+            batch = features[start : start + self.batch_size]
+            if self.session is not None:
+                outputs = self.session.run(None, {self.input_name: batch})[0]
+            else:
+                with torch.inference_mode():
+                    outputs = self.model(torch.from_numpy(batch)).numpy()
+            # Shape (num_models, len(batch)), with a single row for a single model.
+            outputs = outputs.reshape(-1, len(batch))
+            mean[start : start + len(batch)] = outputs.mean(axis=0)
+            variance[start : start + len(batch)] = outputs.var(axis=0)
+        if return_variance:
+            return mean, variance
+        return mean
+
+    def score_rosters(self, rosters, feature_matrix, return_variance=False):
+        """
+        Predict the total fantasy points of many rosters.
+        :param rosters: An integer array of shape (..., team_size) of player IDs, i.e. rows in feature_matrix.
+        :param feature_matrix: A (num_players, num_features) array of normalized player stats, such as
+            PlayerRegistry.prev_season_features.
+        :param return_variance: If True, also return the variance of the predictions of the models of an ensemble.
+        :return: A float32 array of shape (...) with the predicted points of each roster, or with return_variance,
+            a tuple (mean, variance) of two such arrays.
+        """
+        rosters = np.asarray(rosters)
+        features = calculate_team_features(rosters, feature_matrix)
+        mean, variance = self.predict_features(
+            features.reshape(-1, features.shape[-1]), return_variance=True
+        )
+        mean = mean.reshape(rosters.shape[:-1])
+        variance = variance.reshape(rosters.shape[:-1])
+        if return_variance:
+            return mean, variance
+        return mean
@@ -1,31 +1,91 @@
 """
 The purpose of this class is to calculate rotesserie scores for a given set of players in a season.
-For this model, we will assume standard 9-category Roto scoring:
+By default, we will assume standard 9-category Roto scoring:
 https://en.wikipedia.org/wiki/Fantasy_basketball#Rotisserie_(ROTO)
 Categories are: PTS, TRB, AST, TOV, FT%, FG%, 3P, STL, BLK
 In a N-team league, a team will get N points for finishing 1st in a category, and 1 point for finishing last.
 The team that accumulates the most points wins.
+Other formats and category sets are set with Config.scoring, see scoring.py.
 """
 from collections import defaultdict
-import random
+
+import numpy as np
 
 from config import Config
+from scoring import RATIO_CATEGORIES, compile_scoring
+
+
+def season_matrix_from_dict(season_data, stats, players=None):
+    """
+    Build a dense players x stats matrix from a season dictionary.
+    :param season_data: A dictionary with players as keys and their attributes as values.
+    :param stats: The stat columns, i.e. ScoringPlan.stats.
+    :param players: Optional list of player names fixing the row order. Defaults to the dictionary order.
+    :return: A float64 array of shape (num_players, len(stats)).
+    """
+    if players is None:
+        players = list(season_data)
+    try:
+        return np.array(
+            [[season_data[player][stat] for stat in stats] for player in players],
+            dtype=np.float64,
+        )
+    except KeyError as e:
+        raise LookupError(f"Stat or player {e.args[0]} not found in dataset.")
+
+
+def score_leagues(season_matrix, teams, scoring_plan):
+    """
+    Score a batch of leagues.
+    :param season_matrix: A (num_players, len(scoring_plan.stats)) array of season totals.
+    :param teams: An integer array of shape (num_simulations, num_teams, team_size) indexing the matrix rows.
+    :param scoring_plan: A ScoringPlan.
+    :return: The dictionary returned by ScoringPlan.score, with the categories ordered as in the plan.
+    """
+    # Gather the players of every team and sum along the roster axis.
+    return scoring_plan.score(season_matrix[teams].sum(axis=2))
 
 
 class RotoCalculator:
-    def __init__(self, season_data):
+    def __init__(
+        self, season_data, rng=None, players=None, scoring_plan=None, draft_order=None
+    ):
         """
         Constructor.
         :param season_data: A dictionary with players as keys and their attributes as values.
+        :param rng: Optional numpy Generator, SeedSequence or integer seed for all the random draws.
+            Defaults to Config.random_seed, so runs are reproducible.
+        :param players: Optional list of the player names by ID, i.e. from a PlayerRegistry.
+            Defaults to the order of season_data.
+        :param scoring_plan: Optional ScoringPlan. Defaults to the plan compiled from Config.scoring.
+        :param draft_order: Optional array of player IDs by average draft position, best first, used by the
+            snake_adp and stratified samplers. Defaults to the player order.
         """
         self.season_data = season_data
         self.config = Config()
+        self.rng = np.random.default_rng(
+            self.config.random_seed if rng is None else rng
+        )
+        # The mirrored draw left over when a batch ends in the middle of an antithetic pair.
+        self._antithetic_carry = None
+        self.scoring_plan = scoring_plan or compile_scoring(self.config.scoring)
+
+        # Dense representation of the season for the batch engine. Row i belongs to player ID i.
+        self.players = list(season_data) if players is None else list(players)
+        self.season_matrix = season_matrix_from_dict(
+            season_data, self.scoring_plan.stats, self.players
+        )
+        self.draft_order = (
+            np.arange(len(self.players))
+            if draft_order is None
+            else np.asarray(draft_order, dtype=np.int64)
+        )
 
     def calculate_team_stats(self, team):
         """
-        Given a team, calculate its cumulative stats for the 9 categories.
+        Given a team, calculate its cumulative stats for the scoring categories.
         :param team: A list of player names.
-        :return: A dictionary with the 9 stats as keys, and cumulative values as values.
+        :return: A dictionary with the categories as keys, and cumulative values as values.
         """
         team_stats = defaultdict(int)
         for player in team:
@@ -33,26 +93,16 @@ class RotoCalculator:
                 player_info = self.season_data[player]
             except LookupError as e:
                 raise LookupError(f"Player {player} not found in dataset.")
-            stats = [
-                "FG",
-                "FGA",
-                "FT",
-                "FTA",
-                "3P",
-                "STL",
-                "AST",
-                "TRB",
-                "TOV",
-                "BLK",
-                "PTS",
-            ]
-            for stat in stats:
+            for stat in self.scoring_plan.stats:
                 team_stats[stat] += player_info[stat]
-        team_stats["FT%"] = team_stats["FT"] / team_stats["FTA"]
-        team_stats["FG%"] = team_stats["FG"] / team_stats["FGA"]
-        for cat in ["FG", "FGA", "FT", "FTA"]:
-            team_stats.pop(cat)
-        return team_stats
+        category_stats = {}
+        for cat in self.scoring_plan.categories:
+            if cat in RATIO_CATEGORIES:
+                numerator, denominator = RATIO_CATEGORIES[cat]
+                category_stats[cat] = team_stats[numerator] / team_stats[denominator]
+            else:
+                category_stats[cat] = team_stats[cat]
+        return category_stats
 
     def randomly_pick_teams(self, num_teams, team_size):
         """
@@ -61,7 +111,8 @@ class RotoCalculator:
         :param team_size: The size of each team.
         :return: A list of lists of player names.
         """
-        sample_players = random.sample(list(self.season_data), num_teams * team_size)
+        picks = self.rng.choice(len(self.players), num_teams * team_size, replace=False)
+        sample_players = [self.players[i] for i in picks]
         teams = [
             sample_players[i : i + team_size]
             for i in range(0, len(sample_players), team_size)
@@ -79,6 +130,10 @@ class RotoCalculator:
             - 'stats' - the cumulative stats that the team achieved during the season for each category.
             - 'overall_rank' - the overall rank of the team. 1 being highest, num_teams being the lowest.
         """
+        if self.scoring_plan.format != "roto":
+            raise RuntimeError(
+                f"run_simulation only supports roto scoring, use run_simulation_batch for {self.scoring_plan.format}."
+            )
         num_teams = self.config.num_teams
         team_size = self.config.team_size
         teams = self.randomly_pick_teams(num_teams=num_teams, team_size=team_size)
@@ -91,13 +146,12 @@ class RotoCalculator:
             team_info["total_fantasy_pts"] = 0
             team_info["stats"] = self.calculate_team_stats(team)
             all_team_info.append(team_info)
-        stats = ["FG%", "FT%", "3P", "STL", "AST", "TRB", "TOV", "BLK", "PTS"]
-        for stat in stats:
-            reverse = (
-                False if stat == "TOV" else True
-            )  # Ascending for turnover, Descending for everything else.
+        for stat, sign in zip(
+            self.scoring_plan.categories, self.scoring_plan.signs.tolist()
+        ):
+            # Descending, unless lower is better for the category (i.e. turnovers).
             sorted_list = sorted(
-                all_team_info, key=lambda k: k["stats"][stat], reverse=reverse
+                all_team_info, key=lambda k: k["stats"][stat], reverse=sign > 0
             )
             for index, team in enumerate(sorted_list):
                 points = num_teams - index
@@ -110,3 +164,185 @@ class RotoCalculator:
         for index, team in enumerate(sorted_list):
             team["overall_rank"] = index + 1
         return all_team_info
+
+    def _draw(self, draw, mirror, shape):
+        """
+        Random draws for a batch of leagues, the first axis being the league. Each league's draws are
+        contiguous in the RNG stream, so the leagues do not depend on how the simulations are batched.
+        With Config.antithetic_sampling, leagues 2i and 2i + 1 form a pair and the second one gets the mirrored
+        draws of the first. A pair split by the end of a batch is completed at the start of the next one.
+        :param draw: A Generator method, i.e. self.rng.random.
+        :param mirror: Maps draws to their mirror image.
+        :param shape: The shape of the draws, (num_simulations, ...).
+        """
+        if not self.config.antithetic_sampling:
+            return draw(shape)
+        draws = np.empty(shape)
+        start = 0
+        carry = self._antithetic_carry
+        self._antithetic_carry = None
+        if carry is not None and carry[0] == draw and carry[1].shape == shape[1:]:
+            if shape[0]:
+                draws[0] = carry[1]
+                start = 1
+        num_pairs = (shape[0] - start + 1) // 2
+        pairs = draw((num_pairs,) + tuple(shape[1:]))
+        pairs = np.stack([pairs, mirror(pairs)], axis=1).reshape(
+            (-1,) + tuple(shape[1:])
+        )
+        draws[start:] = pairs[: shape[0] - start]
+        if len(pairs) > shape[0] - start:
+            self._antithetic_carry = (draw, pairs[-1])
+        return draws
+
+    def _draw_uniform(self, shape):
+        return self._draw(self.rng.random, lambda u: 1 - u, shape)
+
+    def _draw_normal(self, shape):
+        return self._draw(self.rng.standard_normal, lambda z: -z, shape)
+
+    def _check_league_size(self, num_teams, team_size):
+        num_players = len(self.players)
+        league_size = num_teams * team_size
+        if league_size > num_players:
+            raise ValueError(
+                f"Cannot draft {league_size} players from a pool of {num_players}."
+            )
+        return league_size
+
+    def randomly_pick_teams_batch(self, num_simulations, num_teams, team_size):
+        """
+        Randomly generate the teams for many leagues at once.
+        :param num_simulations: The number of leagues to draw.
+        :param num_teams: The number of teams in the league.
+        :param team_size: The size of each team.
+        :return: An integer array of shape (num_simulations, num_teams, team_size) of player IDs,
+            which are the rows in season_matrix.
+        """
+        league_size = self._check_league_size(num_teams, team_size)
+        # Sorting uniform keys gives a uniformly random permutation per league.
+        keys = self._draw_uniform((num_simulations, len(self.players)))
+        picks = np.argsort(keys, axis=1)[:, :league_size]
+        return picks.reshape(num_simulations, num_teams, team_size)
+
+    def snake_draft_teams_batch(self, num_simulations, num_teams, team_size):
+        """
+        Generate the teams for many leagues with a snake draft. Players are taken in order of their draft
+        position, which is their rank in draft_order plus normal noise of Config.adp_noise picks.
+        Takes the same arguments and returns the same array as randomly_pick_teams_batch.
+        """
+        league_size = self._check_league_size(num_teams, team_size)
+        num_players = len(self.players)
+        adp = np.empty(num_players)
+        adp[self.draft_order] = np.arange(num_players)
+        draft_positions = adp + self.config.adp_noise * self._draw_normal(
+            (num_simulations, num_players)
+        )
+        picks = np.argsort(draft_positions, axis=1, kind="stable")[:, :league_size]
+        # Pick i of round r goes to team i in even rounds, and to team num_teams - 1 - i in odd rounds.
+        rounds = picks.reshape(num_simulations, team_size, num_teams)
+        rounds[:, 1::2] = rounds[:, 1::2, ::-1].copy()
+        return np.ascontiguousarray(rounds.transpose(0, 2, 1))
+
+    def _tier_counts(self, tier_sizes, league_size, allocation=None):
+        """
+        :param allocation: The fraction of the players drawn from each tier. Defaults to proportional to the
+            tier sizes.
+        :return: The number of each league's players drawn from each tier.
+        """
+        if allocation is None:
+            allocation = tier_sizes
+        if len(allocation) != len(tier_sizes):
+            raise ValueError(
+                f"tier_allocation has {len(allocation)} entries for {len(tier_sizes)} tiers."
+            )
+        allocation = np.asarray(allocation, dtype=np.float64)
+        exact = league_size * allocation / allocation.sum()
+        # Round down, then give the remaining players to the largest remainders.
+        counts = np.floor(exact).astype(np.int64)
+        remainders = np.argsort(-(exact - counts), kind="stable")
+        counts[remainders[: league_size - counts.sum()]] += 1
+        if np.any(counts > tier_sizes):
+            raise ValueError(
+                f"Cannot draw {counts.tolist()} players from tiers of {tier_sizes.tolist()} players."
+            )
+        return counts
+
+    def stratified_teams_batch(self, num_simulations, num_teams, team_size):
+        """
+        Generate the teams for many leagues by stratified sampling. The players are split into
+        Config.sampler_tiers tiers by draft_order, and every league takes a fixed number of players from each
+        tier, which are then dealt to the teams at random.
+        :return: A tuple (teams, weights), with teams as returned by randomly_pick_teams_batch and weights an
+            array of shape (num_simulations, num_teams). A team's weight corrects for the over- or under-sampling
+            of its players' tiers relative to the proportional allocation, treating its players as independent
+            draws. With the proportional allocation (Config.tier_allocation None), every weight is 1.
+            Only relative weights are meaningful.
+        """
+        league_size = self._check_league_size(num_teams, team_size)
+        tiers = np.array_split(self.draft_order, self.config.sampler_tiers)
+        tier_sizes = np.array([len(tier) for tier in tiers])
+        counts = self._tier_counts(tier_sizes, league_size, self.config.tier_allocation)
+        # The counts of the proportional allocation, rounded like counts, which the weights are relative to.
+        proportional_counts = self._tier_counts(tier_sizes, league_size)
+
+        # One draw per league: a key for every player to pick within the tiers, then one per pick to deal them.
+        keys = self._draw_uniform((num_simulations, len(self.players) + league_size))
+        tier_keys = np.split(
+            keys[:, : len(self.players)], np.cumsum(tier_sizes)[:-1], axis=1
+        )
+        picks = []
+        pick_tiers = []
+        for tier_index, (tier, count) in enumerate(zip(tiers, counts)):
+            picks.append(tier[np.argsort(tier_keys[tier_index], axis=1)[:, :count]])
+            pick_tiers.append(np.full(count, tier_index))
+        picks = np.concatenate(picks, axis=1)
+        pick_tiers = np.concatenate(pick_tiers)
+
+        # Deal the picks to the teams in a random order.
+        deal = np.argsort(keys[:, len(self.players) :], axis=1)
+        teams = np.take_along_axis(picks, deal, axis=1)
+        teams = teams.reshape(num_simulations, num_teams, team_size)
+
+        # Picks from each tier under the proportional allocation over the picks from it.
+        log_ratios = np.log(proportional_counts / np.maximum(counts, 1e-12))
+        log_weights = log_ratios[pick_tiers][deal].reshape(teams.shape).sum(axis=2)
+        return teams, np.exp(log_weights)
+
+    def pick_teams_batch(self, num_simulations, num_teams, team_size):
+        """
+        Generate the teams for many leagues with the sampler set in Config.league_sampler.
+        :return: A tuple (teams, weights), with teams as returned by randomly_pick_teams_batch and weights an
+            array of shape (num_simulations, num_teams) of sample weights.
+        """
+        sampler = self.config.league_sampler
+        if sampler == "stratified":
+            return self.stratified_teams_batch(num_simulations, num_teams, team_size)
+        if sampler == "uniform":
+            teams = self.randomly_pick_teams_batch(
+                num_simulations, num_teams, team_size
+            )
+        elif sampler == "snake_adp":
+            teams = self.snake_draft_teams_batch(num_simulations, num_teams, team_size)
+        else:
+            raise RuntimeError(
+                f"The following league sampler is not recognized: {sampler}"
+            )
+        return teams, np.ones(teams.shape[:2])
+
+    def run_simulation_batch(self, num_simulations):
+        """
+        Runs many ROTO full-season simulations at once, with leagues drawn by the configured sampler.
+        :param num_simulations: The number of leagues to simulate.
+        :return: A tuple (teams, results), where teams is the (num_simulations, num_teams, team_size) array of
+            player rows and results is the dictionary returned by ScoringPlan.score, with an extra
+            'sample_weight' key holding the (num_simulations, num_teams) sample weights.
+        """
+        teams, weights = self.pick_teams_batch(
+            num_simulations=num_simulations,
+            num_teams=self.config.num_teams,
+            team_size=self.config.team_size,
+        )
+        results = score_leagues(self.season_matrix, teams, self.scoring_plan)
+        results["sample_weight"] = weights
+        return teams, results
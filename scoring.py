@@ -0,0 +1,173 @@
+"""
+League scoring rules.
+A league's scoring is declared as a spec on Config (see Config.scoring) and compiled once into a ScoringPlan:
+the stat columns to gather, index arrays for the counting and ratio categories, and a sign per category.
+The plan then scores any batch of leagues with a fixed sequence of array operations, whatever the format.
+Supported formats:
+    - roto: each category is ranked across the league, num_teams points for first and 1 point for last.
+    - h2h_categories: every team plays every other team once on its season totals, and earns 1 point per
+        category won and 0.5 per category tied.
+    - points: each stat is worth a fixed number of points.
+"""
+import numpy as np
+
+# Categories computed as the ratio of two summed stats, i.e. FG% is the team's FG over its FGA.
+RATIO_CATEGORIES = {
+    "FG%": ("FG", "FGA"),
+    "FT%": ("FT", "FTA"),
+    "3P%": ("3P", "3PA"),
+}
+
+SCORING_FORMATS = ["roto", "h2h_categories", "points"]
+
+
+class ScoringPlan:
+    def __init__(self, scoring_format, categories, stats, signs, weights=None):
+        """
+        Constructor. Use compile_scoring to build a plan from a spec.
+        :param scoring_format: One of SCORING_FORMATS.
+        :param categories: The category names, in output order.
+        :param stats: The stat columns summed over a roster, in the order of the season matrix columns.
+        :param signs: A (num_categories,) array, 1 where higher is better and -1 where lower is better.
+        :param weights: For points leagues, a (num_categories,) array of points per unit of each category.
+        """
+        self.format = scoring_format
+        self.categories = list(categories)
+        self.stats = list(stats)
+        self.signs = np.asarray(signs, dtype=np.float64)
+        self.weights = None if weights is None else np.asarray(weights, np.float64)
+
+        col = {stat: i for i, stat in enumerate(self.stats)}
+        ratios = [
+            (i, col[RATIO_CATEGORIES[cat][0]], col[RATIO_CATEGORIES[cat][1]])
+            for i, cat in enumerate(self.categories)
+            if cat in RATIO_CATEGORIES
+        ]
+        counting = [
+            (i, col[cat])
+            for i, cat in enumerate(self.categories)
+            if cat not in RATIO_CATEGORIES
+        ]
+        # Positions in the category axis, and the stat columns they are computed from.
+        self.ratio_positions = np.array([r[0] for r in ratios], dtype=np.int64)
+        self.ratio_numerators = np.array([r[1] for r in ratios], dtype=np.int64)
+        self.ratio_denominators = np.array([r[2] for r in ratios], dtype=np.int64)
+        self.counting_positions = np.array([c[0] for c in counting], dtype=np.int64)
+        self.counting_columns = np.array([c[1] for c in counting], dtype=np.int64)
+
+    @property
+    def num_categories(self):
+        return len(self.categories)
+
+    def category_values(self, totals):
+        """
+        :param totals: An array of shape (..., len(stats)) of team totals.
+        :return: A float64 array of shape (..., num_categories), ordered as categories.
+        """
+        values = np.empty(totals.shape[:-1] + (self.num_categories,), dtype=np.float64)
+        values[..., self.counting_positions] = totals[..., self.counting_columns]
+        values[..., self.ratio_positions] = (
+            totals[..., self.ratio_numerators] / totals[..., self.ratio_denominators]
+        )
+        return values
+
+    def category_points(self, values):
+        """
+        :param values: An array of shape (num_simulations, num_teams, num_categories) of category values.
+        :return: An array of the same shape with the points each team earns in each category.
+        """
+        num_teams = values.shape[1]
+        if self.format == "points":
+            return values * self.weights
+        # Multiplying by the signs makes higher better in every category.
+        signed = values * self.signs
+        if self.format == "roto":
+            # Ties keep the team order, matching the stable sort used by run_simulation.
+            order = np.argsort(-signed, axis=1, kind="stable")
+            points = np.empty(values.shape, dtype=np.int64)
+            np.put_along_axis(
+                points,
+                order,
+                np.broadcast_to(
+                    np.arange(num_teams, 0, -1).reshape(1, num_teams, 1), values.shape
+                ),
+                axis=1,
+            )
+            return points
+        # h2h_categories: compare every pair of teams, shape (num_simulations, team, opponent, num_categories).
+        team = signed[:, :, np.newaxis, :]
+        opponent = signed[:, np.newaxis, :, :]
+        return (team > opponent).sum(axis=2) + 0.5 * (
+            (team == opponent).sum(axis=2) - 1
+        )
+
+    def score(self, totals):
+        """
+        Score a batch of leagues from the teams' summed stats.
+        :param totals: A (num_simulations, num_teams, len(stats)) array of team totals.
+        :return: A dictionary of arrays, with the keys being:
+            - 'stats' - (num_simulations, num_teams, num_categories) cumulative category values.
+            - 'rankings' - (num_simulations, num_teams, num_categories) points per category.
+            - 'total_fantasy_pts' - (num_simulations, num_teams) summed points.
+            - 'overall_rank' - (num_simulations, num_teams) rank of each team, 1 being highest.
+        """
+        num_teams = totals.shape[1]
+        stats = self.category_values(totals)
+        rankings = self.category_points(stats)
+        total_fantasy_pts = rankings.sum(axis=2)
+
+        overall_order = np.argsort(-total_fantasy_pts, axis=1, kind="stable")
+        overall_rank = np.empty_like(overall_order)
+        np.put_along_axis(
+            overall_rank,
+            overall_order,
+            np.broadcast_to(np.arange(1, num_teams + 1), overall_order.shape),
+            axis=1,
+        )
+        return {
+            "stats": stats,
+            "rankings": rankings,
+            "total_fantasy_pts": total_fantasy_pts,
+            "overall_rank": overall_rank,
+        }
+
+
+def compile_scoring(spec):
+    """
+    Compile a scoring spec into a ScoringPlan.
+    :param spec: A dictionary with the keys being:
+        - 'format' - one of SCORING_FORMATS.
+        - 'categories' - for category leagues, the category names. Ratio categories are the keys of
+            RATIO_CATEGORIES, any other category is a stat column of the season data.
+        - 'lower_is_better' - for category leagues, the categories ranked ascending, i.e. turnovers.
+        - 'points' - for points leagues, a dictionary with stat columns as keys and points per unit as values.
+    :return: A ScoringPlan.
+    """
+    scoring_format = spec["format"]
+    if scoring_format not in SCORING_FORMATS:
+        raise RuntimeError(
+            f"The following scoring format is not recognized: {scoring_format}"
+        )
+
+    if scoring_format == "points":
+        categories = list(spec["points"])
+        signs = np.sign([spec["points"][cat] for cat in categories])
+        weights = [spec["points"][cat] for cat in categories]
+    else:
+        categories = list(spec["categories"])
+        lower_is_better = set(spec.get("lower_is_better", []))
+        unknown = lower_is_better - set(categories)
+        if unknown:
+            raise ValueError(f"Categories {sorted(unknown)} are not scored.")
+        signs = [-1 if cat in lower_is_better else 1 for cat in categories]
+        weights = None
+    if len(set(categories)) != len(categories):
+        raise ValueError(f"Categories are not unique: {categories}")
+
+    # The stat columns, in the order they are first needed.
+    stats = []
+    for cat in categories:
+        for stat in RATIO_CATEGORIES.get(cat, (cat,)):
+            if stat not in stats:
+                stats.append(stat)
+    return ScoringPlan(scoring_format, categories, stats, signs, weights)
@@ -0,0 +1,178 @@
+"""
+Storage backends for the generated training, test and validation data.
+Every backend writes a 2D float32 table (features followed by the label) and reads it back as a numpy array.
+Each data directory also holds a manifest describing the files in it, which both the generator and the
+ML workflow use.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class CSVStorage:
+    extension = ".csv"
+
+    def write(self, path, data, columns):
+        pd.DataFrame(data, columns=columns).to_csv(path, index=False)
+
+    def read(self, path):
+        return pd.read_csv(path, dtype=np.float32).to_numpy()
+
+
+class NpyStorage:
+    extension = ".npy"
+
+    def write(self, path, data, columns):
+        # Write through a file handle, so numpy does not append its own extension to temporary names.
+        with open(path, "wb") as f:
+            np.save(f, np.ascontiguousarray(data, dtype=np.float32))
+
+    def read(self, path, mmap_mode=None):
+        return np.load(path, mmap_mode=mmap_mode)
+
+
+class FeatherStorage:
+    """
+    Requires pyarrow.
+    """
+
+    extension = ".feather"
+
+    def write(self, path, data, columns):
+        pd.DataFrame(data, columns=columns, dtype=np.float32).to_feather(path)
+
+    def read(self, path):
+        return pd.read_feather(path).to_numpy(dtype=np.float32)
+
+
+class ParquetStorage:
+    """
+    Requires pyarrow.
+    """
+
+    extension = ".parquet"
+
+    def write(self, path, data, columns):
+        pd.DataFrame(data, columns=columns, dtype=np.float32).to_parquet(
+            path, index=False
+        )
+
+    def read(self, path):
+        return pd.read_parquet(path).to_numpy(dtype=np.float32)
+
+
+STORAGE_BACKENDS = {
+    "csv": CSVStorage,
+    "npy": NpyStorage,
+    "feather": FeatherStorage,
+    "parquet": ParquetStorage,
+}
+
+
+def get_storage(storage_format):
+    try:
+        return STORAGE_BACKENDS[storage_format]()
+    except KeyError:
+        raise RuntimeError(
+            f"The following storage format is not recognized: {storage_format}"
+        )
+
+
+def storage_for_file(file_name):
+    """
+    Select the backend that wrote a file from its extension.
+    """
+    for backend in STORAGE_BACKENDS.values():
+        if file_name.endswith(backend.extension):
+            return backend()
+    raise RuntimeError(f"No storage backend for file: {file_name}")
+
+
+class Manifest:
+    """
+    The manifest of a data directory. It maps each file name to a dictionary describing the file,
+    i.e. its season, num_teams, team_size and number of rows.
+    """
+
+    file_name = "manifest.json"
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.path = os.path.join(data_dir, self.file_name)
+        self.columns = None
+        self.files = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                manifest = json.load(f)
+            self.columns = manifest["columns"]
+            self.files = manifest["files"]
+
+    def add(self, file_name, columns, **entry):
+        if self.columns is not None and self.columns != list(columns):
+            raise RuntimeError(
+                f"Columns of {file_name} do not match the manifest in {self.data_dir}."
+            )
+        self.columns = list(columns)
+        self.files[file_name] = entry
+        self.save()
+
+    def remove(self, file_name):
+        if self.files.pop(file_name, None) is not None:
+            self.save()
+
+    def save(self):
+        os.makedirs(self.data_dir, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {"columns": self.columns, "files": self.files},
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+        os.replace(tmp_path, self.path)
+
+    def num_rows(self):
+        return sum(entry["rows"] for entry in self.files.values())
+
+    def file_paths(self):
+        return [os.path.join(self.data_dir, name) for name in sorted(self.files)]
+
+
+def find_manifests(root_dir):
+    """
+    Find the manifests of every data directory under root_dir.
+    :return: A list of Manifest objects, sorted by directory.
+    """
+    return [
+        Manifest(dir_path)
+        for dir_path, _, file_names in sorted(os.walk(root_dir))
+        if Manifest.file_name in file_names
+    ]
+
+
+def read_manifests(manifests, columns):
+    """
+    Read every file listed in the manifests into one preallocated float32 array.
+    :param manifests: A list of Manifest objects.
+    :param columns: The expected column names.
+    :return: A numpy array of shape (total rows, len(columns)).
+    """
+    for manifest in manifests:
+        if manifest.columns != list(columns):
+            raise RuntimeError(
+                f"Columns in {manifest.path} do not match the configured vector columns."
+            )
+    data = np.empty(
+        (sum(manifest.num_rows() for manifest in manifests), len(columns)),
+        dtype=np.float32,
+    )
+    row = 0
+    for manifest in manifests:
+        for path in manifest.file_paths():
+            values = storage_for_file(path).read(path)
+            data[row : row + len(values)] = values
+            row += len(values)
+    return data
@@ -0,0 +1,394 @@
+"""
+Hyperparameter sweeps over the model configs of Config.
+The datasets are loaded once, moved to shared memory, and every trial trains a FeedforwardNeuralNetModel
+variant in a pool of worker processes that read the same tensors. Each worker gets an equal share of the CPU
+threads. Supported strategies:
+    - grid: every combination of the values in the search space.
+    - random: num_trials configs sampled from the search space.
+    - asha: successive halving. num_trials random configs are trained for min_epochs, the best 1/eta of them
+        continue to eta times as many epochs, and so on up to Config.epochs. Promoted trials resume from their
+        trainer state rather than starting over.
+Every finished trial (and ASHA rung) is recorded in a SQLite leaderboard in the sweep directory, which is also
+exported to JSON. Run this module directly to start a sweep.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import itertools
+import json
+import math
+import os
+import sqlite3
+import time
+
+import numpy as np
+import torch
+
+# Logging
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(levelname)s: \n %(message)s \n"
+)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+from config import Config
+from instrumentation import metrics
+from ml_workflow import MLWorkflow
+from nnmodeldataset import NNModelDataSet
+
+SWEEP_STRATEGIES = ["grid", "random", "asha"]
+
+# A list is a set of choices. A tuple (low, high) is a range sampled log-uniformly, rounded for integers.
+DEFAULT_SPACE = {
+    "hidden_layer_sizes": [[32, 16], [64, 32], [128, 64], [64, 32, 16]],
+    "activation": ["relu", "leaky_relu", "tanh"],
+    "learning_rate": (1e-4, 1e-1),
+    "weight_decay": [0, 1e-5, 1e-4],
+    "dropout": [False, 0.1, 0.2],
+    "optimizer": ["adam", "sgd_m", "rmsprop"],
+    "batch_size": [256, 1024, 4096],
+}
+
+# The datasets of a worker process, set by _init_worker.
+_datasets = None
+
+
+def _init_worker(datasets, num_threads):
+    """
+    Initializer of the worker processes.
+    """
+    global _datasets
+    _datasets = datasets
+    torch.set_num_threads(num_threads)
+    # The trials run concurrently, so their epoch logs and timings would be interleaved.
+    logging.getLogger("ml_workflow").setLevel(logging.WARNING)
+    metrics.enabled = False
+
+
+def _run_trial(trial_id, overrides, stop_epoch=None, state=None):
+    """
+    Train one config.
+    :param trial_id: The ID of the trial, which also seeds its initial weights.
+    :param overrides: The Config overrides of the trial.
+    :param stop_epoch: Optional number of epochs after which to stop. Defaults to Config.epochs.
+    :param state: Optional trainer state to resume from, i.e. of the previous ASHA rung.
+    :return: A dictionary with the results of MLWorkflow.fit, the test loss of the best model, the training
+        time and the trainer state after the last epoch.
+    """
+    train_data, test_data, validation_data = _datasets
+    config = Config(overrides)
+    if state is None:
+        torch.manual_seed(config.random_seed + trial_id)
+    workflow = MLWorkflow(config=config)
+    start = time.perf_counter()
+    results = workflow.fit(
+        train_data, validation_data, state=state, stop_epoch=stop_epoch
+    )
+    results["train_time"] = time.perf_counter() - start
+    results["state"] = workflow.trainer_state(results["epochs"] - 1)
+    workflow.restore_best_model()
+    results["test_loss"] = workflow.evaluate(test_data)
+    return results
+
+
+class Leaderboard:
+    """
+    The results of a sweep, in a SQLite database with one row per trial and number of epochs trained.
+    """
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS trials (
+                trial_id INTEGER,
+                epochs INTEGER,
+                config TEXT,
+                validation_loss REAL,
+                test_loss REAL,
+                stopped_early INTEGER,
+                train_time REAL,
+                model_path TEXT,
+                PRIMARY KEY (trial_id, epochs)
+            )
+            """)
+        self.connection.commit()
+
+    def record(self, trial_id, overrides, results):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                trial_id,
+                results["epochs"],
+                json.dumps(overrides, sort_keys=True),
+                results["best_loss"],
+                results["test_loss"],
+                int(results["stopped_early"]),
+                results["train_time"],
+                overrides["model_path"],
+            ),
+        )
+        self.connection.commit()
+
+    def rows(self):
+        """
+        :return: The latest row of every trial as a dictionary, best validation loss first.
+        """
+        cursor = self.connection.execute("""
+            SELECT trial_id, MAX(epochs), config, validation_loss, test_loss, stopped_early, train_time,
+                model_path
+            FROM trials
+            GROUP BY trial_id
+            ORDER BY validation_loss IS NULL, validation_loss
+            """)
+        columns = ["trial_id", "epochs", "config", "validation_loss", "test_loss"]
+        columns += ["stopped_early", "train_time", "model_path"]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        for row in rows:
+            row["config"] = json.loads(row["config"])
+            row["stopped_early"] = bool(row["stopped_early"])
+        return rows
+
+    def export_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.rows(), f, indent=2)
+
+    def close(self):
+        self.connection.close()
+
+
+class HyperparameterSweep:
+    def __init__(
+        self,
+        space=None,
+        strategy="random",
+        num_trials=20,
+        num_workers=None,
+        sweep_dir="sweeps",
+        min_epochs=None,
+        eta=3,
+        seed=None,
+    ):
+        """
+        Constructor.
+        :param space: A dictionary with Config settings as keys, and lists of choices or (low, high) ranges as
+            values. Defaults to DEFAULT_SPACE. Ranges are only supported by the random and asha strategies.
+        :param strategy: One of SWEEP_STRATEGIES.
+        :param num_trials: Number of configs of the random and asha strategies.
+        :param num_workers: Number of trials trained concurrently. Defaults to Config.num_workers.
+        :param sweep_dir: The directory of the leaderboard and of the trials' models.
+        :param min_epochs: Epochs of the first ASHA rung. Defaults to Config.epochs // eta ** 2.
+        :param eta: Reduction factor between ASHA rungs.
+        :param seed: Optional seed of the sampled configs. Defaults to Config.random_seed.
+        """
+        if strategy not in SWEEP_STRATEGIES:
+            raise RuntimeError(f"The following strategy is not recognized: {strategy}")
+        self.config = Config()
+        self.space = DEFAULT_SPACE if space is None else space
+        self.strategy = strategy
+        self.num_trials = num_trials
+        self.num_workers = max(num_workers or self.config.num_workers, 1)
+        self.sweep_dir = sweep_dir
+        self.eta = eta
+        self.min_epochs = max(min_epochs or self.config.epochs // eta**2, 1)
+        self.rng = np.random.default_rng(
+            self.config.random_seed if seed is None else seed
+        )
+
+    def grid_configs(self):
+        for name, values in self.space.items():
+            if not isinstance(values, list):
+                raise ValueError(f"Grid sweeps need a list of choices for {name}.")
+        names = list(self.space)
+        return [
+            dict(zip(names, values))
+            for values in itertools.product(*self.space.values())
+        ]
+
+    def sample_config(self):
+        config = {}
+        for name, values in self.space.items():
+            if isinstance(values, tuple):
+                low, high = values
+                value = math.exp(self.rng.uniform(math.log(low), math.log(high)))
+                if isinstance(low, int) and isinstance(high, int):
+                    value = int(round(value))
+                config[name] = value
+            else:
+                config[name] = values[self.rng.integers(len(values))]
+        return config
+
+    def trial_overrides(self, trial_id, config):
+        """
+        :return: The Config overrides of a trial: its config, plus a model file of its own and no checkpoints.
+        """
+        overrides = dict(config)
+        overrides["model_path"] = os.path.join(
+            self.sweep_dir, "models", f"trial_{trial_id}.pt"
+        )
+        overrides["checkpoint_path"] = None
+        overrides["resume_training"] = False
+        return overrides
+
+    def load_datasets(self):
+        """
+        Load the datasets once for all trials. The in-memory tensors are moved to shared memory, so the worker
+        processes read them instead of receiving copies. Memory-mapped datasets are shared through the page cache.
+        """
+        if self.config.online_training:
+            raise RuntimeError("Sweeps are not supported with online_training.")
+        datasets = MLWorkflow().load_datasets()
+        for dataset in datasets:
+            if isinstance(dataset, NNModelDataSet):
+                dataset.data.share_memory_()
+                dataset.labels.share_memory_()
+                if dataset.weights is not None:
+                    dataset.weights.share_memory_()
+        return datasets
+
+    def run(self):
+        """
+        Run the sweep.
+        :return: The leaderboard rows, best validation loss first.
+        """
+        with metrics.timer("data_read"):
+            datasets = self.load_datasets()
+        if self.strategy == "grid":
+            configs = self.grid_configs()
+        else:
+            configs = [self.sample_config() for _ in range(self.num_trials)]
+        trials = {
+            trial_id: self.trial_overrides(trial_id, config)
+            for trial_id, config in enumerate(configs)
+        }
+        logger.info(f"Running a {self.strategy} sweep of {len(trials)} configs...")
+
+        leaderboard = Leaderboard(os.path.join(self.sweep_dir, "leaderboard.db"))
+        num_threads = max(
+            (self.config.num_threads or os.cpu_count() or 1) // self.num_workers, 1
+        )
+        with ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            initializer=_init_worker,
+            initargs=(datasets, num_threads),
+        ) as executor:
+            if self.strategy == "asha":
+                self.run_rungs(executor, trials, leaderboard)
+            else:
+                self.run_trials(executor, trials, leaderboard)
+
+        leaderboard.export_json(os.path.join(self.sweep_dir, "leaderboard.json"))
+        rows = leaderboard.rows()
+        leaderboard.close()
+        if rows:
+            logger.info(
+                f"Best config: {rows[0]['config']}\n"
+                f"Validation Loss: {rows[0]['validation_loss']}, Test Loss: {rows[0]['test_loss']}"
+            )
+        return rows
+
+    def run_trials(self, executor, trials, leaderboard, stop_epoch=None, states=None):
+        """
+        Train trials concurrently, and record them as they finish.
+        :param trials: A dictionary with trial IDs as keys and Config overrides as values.
+        :param states: Optional dictionary with trial IDs as keys and trainer states to resume from as values.
+        :return: A dictionary with trial IDs as keys and the results of _run_trial as values.
+        """
+        states = states or {}
+        futures = {
+            executor.submit(
+                _run_trial, trial_id, overrides, stop_epoch, states.get(trial_id)
+            ): trial_id
+            for trial_id, overrides in trials.items()
+        }
+        results = {}
+        for future in as_completed(futures):
+            trial_id = futures[future]
+            results[trial_id] = future.result()
+            leaderboard.record(trial_id, trials[trial_id], results[trial_id])
+            logger.info(
+                f"Trial {trial_id} ({results[trial_id]['epochs']} epochs): "
+                f"Validation Loss: {results[trial_id]['best_loss']}"
+            )
+        return results
+
+    def run_rungs(self, executor, trials, leaderboard):
+        """
+        Successive halving: train every trial for min_epochs, and promote the best 1/eta of each rung to the
+        next, which trains eta times as many epochs, until Config.epochs.
+        """
+        stop_epoch = min(self.min_epochs, self.config.epochs)
+        states = {}
+        while trials:
+            results = self.run_trials(
+                executor, trials, leaderboard, stop_epoch=stop_epoch, states=states
+            )
+            if stop_epoch >= self.config.epochs:
+                break
+            # Trials that stopped early or never improved are not promoted.
+            ranked = sorted(
+                (
+                    (result["best_loss"], trial_id)
+                    for trial_id, result in results.items()
+                    if result["best_loss"] is not None and not result["stopped_early"]
+                ),
+            )
+            promoted = [
+                trial_id for _, trial_id in ranked[: max(len(trials) // self.eta, 1)]
+            ]
+            trials = {trial_id: trials[trial_id] for trial_id in promoted}
+            states = {trial_id: results[trial_id]["state"] for trial_id in promoted}
+            stop_epoch = min(stop_epoch * self.eta, self.config.epochs)
+            logger.info(f"Promoted trials {promoted} to {stop_epoch} epochs.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--strategy",
+        choices=SWEEP_STRATEGIES,
+        default="random",
+        help="Search strategy.",
+    )
+    parser.add_argument(
+        "--space",
+        help='Path of a JSON file with the search space. Ranges are written as {"range": [low, high]}.',
+    )
+    parser.add_argument(
+        "--trials", type=int, default=20, help="Number of random or asha configs."
+    )
+    parser.add_argument(
+        "--workers", type=int, help="Number of trials trained concurrently."
+    )
+    parser.add_argument(
+        "--sweep-dir", default="sweeps", help="Directory of the leaderboard and models."
+    )
+    parser.add_argument("--min-epochs", type=int, help="Epochs of the first asha rung.")
+    parser.add_argument(
+        "--eta", type=int, default=3, help="Reduction factor between asha rungs."
+    )
+    args = parser.parse_args()
+
+    space = None
+    if args.space:
+        with open(args.space) as f:
+            space = {
+                name: tuple(values["range"]) if isinstance(values, dict) else values
+                for name, values in json.load(f).items()
+            }
+    HyperparameterSweep(
+        space=space,
+        strategy=args.strategy,
+        num_trials=args.trials,
+        num_workers=args.workers,
+        sweep_dir=args.sweep_dir,
+        min_epochs=args.min_epochs,
+        eta=args.eta,
+    ).run()
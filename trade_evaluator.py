@@ -0,0 +1,222 @@
+"""
+Trade analysis for a fixed set of rosters, i.e. our actual league.
+The evaluator keeps every team's counting stat totals, including the makes and attempts behind FG% and FT%.
+A trade changes the totals of the two teams involved by the difference of the traded players' stats, so it is
+applied as an O(categories) delta, and only the categories whose values changed are re-ranked.
+Ranks follow ScoringPlan.score for roto leagues: ties keep the team order, and categories where lower is better
+(i.e. turnovers) are ranked ascending.
+"""
+from itertools import combinations
+
+import numpy as np
+
+from roto_calculator import RotoCalculator
+
+
+def _roto_points_against(values, others, before_others, num_teams):
+    """
+    Roto points of teams against a fixed set of other teams, by counting the teams ranked above them.
+    :param values: An array of shape (..., num_categories) of signed category values, higher being better.
+    :param others: An array of shape (num_others, num_categories) of signed category values of the other teams.
+    :param before_others: A boolean array of shape (..., num_others), True where the other team comes first in the
+        team order, and so wins a tie.
+    :param num_teams: The number of teams in the league.
+    :return: An integer array of shape (..., num_categories). Only counts the other teams, so the caller adjusts for the rest.
+    """
+    values = values[..., np.newaxis, :]
+    above = (others > values) | ((others == values) & before_others[..., np.newaxis])
+    return num_teams - above.sum(axis=-2)
+
+
+class TradeEvaluator:
+    def __init__(self, season_data, rosters, players=None, scoring_plan=None):
+        """
+        Constructor.
+        :param season_data: A dictionary with players as keys and their attributes as values.
+        :param rosters: A list with the player names of each team.
+        :param players: Optional list of the player names by ID, i.e. from a PlayerRegistry.
+        :param scoring_plan: Optional roto ScoringPlan. Defaults to the plan compiled from Config.scoring.
+        """
+        self.roto_calculator = RotoCalculator(
+            season_data, players=players, scoring_plan=scoring_plan
+        )
+        self.scoring_plan = self.roto_calculator.scoring_plan
+        if self.scoring_plan.format != "roto":
+            raise RuntimeError(
+                f"Trades can only be evaluated for roto scoring, not {self.scoring_plan.format}."
+            )
+        self.players = self.roto_calculator.players
+        self.player_ids = {
+            player: player_id for player_id, player in enumerate(self.players)
+        }
+        self.season_matrix = self.roto_calculator.season_matrix
+        self.rosters = [list(self.ids(roster)) for roster in rosters]
+        self.num_teams = len(self.rosters)
+        # Multiplying by the signs makes higher better in every category.
+        self.signs = self.scoring_plan.signs
+        self._score()
+
+    def ids(self, players):
+        try:
+            return np.array(
+                [self.player_ids[player] for player in players], dtype=np.int64
+            )
+        except KeyError as e:
+            raise LookupError(f"Player {e.args[0]} not found in dataset.")
+
+    def _score(self):
+        self.team_totals = np.stack(
+            [self.season_matrix[roster].sum(axis=0) for roster in self.rosters]
+        )
+        results = self.scoring_plan.score(self.team_totals[np.newaxis])
+        self.stats = results["stats"][0]
+        self.rankings = results["rankings"][0]
+        self.total_fantasy_pts = results["total_fantasy_pts"][0]
+
+    def _rank_categories(self, stats, categories):
+        """
+        Roto points of every team in some categories.
+        :param stats: A (num_teams, num_categories) array of category values.
+        :param categories: The indices of the categories to rank.
+        :return: A (num_teams, len(categories)) integer array.
+        """
+        values = stats[:, categories] * self.signs[categories]
+        team_order = np.arange(self.num_teams)
+        before = team_order[np.newaxis, :] < team_order[:, np.newaxis]
+        # Every team is counted against itself as neither above nor below.
+        return _roto_points_against(values, values, before, self.num_teams)
+
+    def evaluate_trade(self, team_a, players_a, team_b, players_b):
+        """
+        Evaluate a trade without applying it.
+        :param team_a: Index of the first team.
+        :param players_a: Names of the players that the first team gives up.
+        :param team_b: Index of the second team.
+        :param players_b: Names of the players that the second team gives up.
+        :return: A dictionary with the keys being:
+            - 'delta_pts' - (num_teams,) change in total roto points of every team.
+            - 'total_fantasy_pts' - (num_teams,) total roto points after the trade.
+            - 'rankings' - (num_teams, num_categories) roto points per category after the trade.
+            - 'changed_categories' - the names of the categories re-ranked.
+        """
+        ids_a, ids_b = self.ids(players_a), self.ids(players_b)
+        for team, ids in [(team_a, ids_a), (team_b, ids_b)]:
+            missing = set(ids.tolist()) - set(self.rosters[team])
+            if missing:
+                names = [self.players[player] for player in sorted(missing)]
+                raise LookupError(f"Players {names} are not on team {team}.")
+
+        delta = self.season_matrix[ids_b].sum(axis=0) - self.season_matrix[ids_a].sum(
+            axis=0
+        )
+        stats = self.stats.copy()
+        stats[[team_a, team_b]] = self.scoring_plan.category_values(
+            self.team_totals[[team_a, team_b]] + np.stack([delta, -delta])
+        )
+        changed = np.flatnonzero(
+            (stats[[team_a, team_b]] != self.stats[[team_a, team_b]]).any(axis=0)
+        )
+
+        rankings = self.rankings.copy()
+        rankings[:, changed] = self._rank_categories(stats, changed)
+        total_fantasy_pts = rankings.sum(axis=1)
+        return {
+            "delta_pts": total_fantasy_pts - self.total_fantasy_pts,
+            "total_fantasy_pts": total_fantasy_pts,
+            "rankings": rankings,
+            "changed_categories": [self.scoring_plan.categories[i] for i in changed],
+        }
+
+    def apply_trade(self, team_a, players_a, team_b, players_b):
+        """
+        Apply a trade to the rosters. Takes the same arguments as evaluate_trade.
+        """
+        results = self.evaluate_trade(team_a, players_a, team_b, players_b)
+        ids_a, ids_b = self.ids(players_a), self.ids(players_b)
+        self.rosters[team_a] = [p for p in self.rosters[team_a] if p not in ids_a]
+        self.rosters[team_a] += ids_b.tolist()
+        self.rosters[team_b] = [p for p in self.rosters[team_b] if p not in ids_b]
+        self.rosters[team_b] += ids_a.tolist()
+        delta = self.season_matrix[ids_b].sum(axis=0) - self.season_matrix[ids_a].sum(
+            axis=0
+        )
+        self.team_totals[team_a] += delta
+        self.team_totals[team_b] -= delta
+        self.stats[[team_a, team_b]] = self.scoring_plan.category_values(
+            self.team_totals[[team_a, team_b]]
+        )
+        self.rankings = results["rankings"]
+        self.total_fantasy_pts = results["total_fantasy_pts"]
+        return results
+
+    def _packages(self, team, trade_size):
+        """
+        :return: A tuple (player IDs, stat totals) of every group of trade_size players on the team, with shapes
+            (num_packages, trade_size) and (num_packages, len(scoring_plan.stats)).
+        """
+        roster = np.array(self.rosters[team], dtype=np.int64)
+        if not 1 <= trade_size <= len(roster):
+            raise ValueError(
+                f"Trade size {trade_size} must be between 1 and the {len(roster)} players of team {team}."
+            )
+        positions = np.array(list(combinations(range(len(roster)), trade_size)))
+        packages = roster[positions].reshape(-1, trade_size)
+        return packages, self.season_matrix[packages].sum(axis=1)
+
+    def sweep_trades(self, trade_sizes=(1, 2)):
+        """
+        Evaluate every possible trade between every pair of teams in one batched pass per pair.
+        :param trade_sizes: The numbers of players swapped, i.e. 1 for 1-for-1 and 2 for 2-for-2 trades.
+        :return: A list with one dictionary per pair of teams and trade size, with the keys being:
+            - 'team_a', 'team_b' - the indices of the teams.
+            - 'players_a', 'players_b' - (num_trades, trade_size) IDs of the players each team gives up.
+            - 'delta_a', 'delta_b' - (num_trades,) change in total roto points of each team.
+        """
+        team_order = np.arange(self.num_teams)
+        values = self.stats * self.signs
+        sweeps = []
+        for trade_size in trade_sizes:
+            packages = [
+                self._packages(team, trade_size) for team in range(self.num_teams)
+            ]
+            for team_a, team_b in combinations(range(self.num_teams), 2):
+                ids_a, out_a = packages[team_a]
+                ids_b, out_b = packages[team_b]
+                # Every (package of a, package of b) pair, shape (len(ids_a), len(ids_b), len(stats)).
+                delta = out_b[np.newaxis, :, :] - out_a[:, np.newaxis, :]
+                new_a = self.scoring_plan.category_values(
+                    self.team_totals[team_a] + delta
+                )
+                new_b = self.scoring_plan.category_values(
+                    self.team_totals[team_b] - delta
+                )
+                new_a *= self.signs
+                new_b *= self.signs
+
+                others = np.flatnonzero((team_order != team_a) & (team_order != team_b))
+                rankings_a = _roto_points_against(
+                    new_a, values[others], others < team_a, self.num_teams
+                )
+                rankings_b = _roto_points_against(
+                    new_b, values[others], others < team_b, self.num_teams
+                )
+                # Team a comes first in the team order, so wins ties against team b.
+                b_above_a = new_b > new_a
+                rankings_a -= b_above_a
+                rankings_b -= ~b_above_a
+
+                sweeps.append(
+                    {
+                        "team_a": team_a,
+                        "team_b": team_b,
+                        "players_a": np.repeat(ids_a, len(ids_b), axis=0),
+                        "players_b": np.tile(ids_b, (len(ids_a), 1)),
+                        "delta_a": (
+                            rankings_a.sum(axis=-1) - self.total_fantasy_pts[team_a]
+                        ).reshape(-1),
+                        "delta_b": (
+                            rankings_b.sum(axis=-1) - self.total_fantasy_pts[team_b]
+                        ).reshape(-1),
+                    }
+                )
+        return sweeps
@@ -7,9 +7,17 @@ Then for each team, we will take the players' previous year's stats as features.
 We accumulate the team's stats to get a training vector of length 15, which has format:
 [Age G GS MP/game FG/game FGA/game 3P/game FT/game FTA/game TRB/game AST/game STL/game BLK/game TOV/game PTS/game]
 The final label will be the total amount of fantasy points that the team scored.
+Each row also records a sample weight, which is 1 unless the league sampler over- or under-samples some players.
+The simulations of a season are split into shards, and each shard is written to its own file as it completes.
+Every data directory has a manifest listing its files with their season, team count, team size and row count.
+The manifest also records the simulations, seed, generation settings and a digest of the season data of each
+file, so that files generated from other settings or data are regenerated rather than reused.
 """
+import hashlib
+import json
 import os
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 
 # Logging
 import logging
@@ -27,71 +35,371 @@ logger.addHandler(handler)
 
 from roto_calculator import RotoCalculator
 from config import Config
-from utils import calculate_team_prev_season_data
+from instrumentation import metrics, profile
+from storage import Manifest, get_storage
+from player_registry import PlayerRegistry
+from utils import calculate_team_features
+
+# Generator used by each worker process of the process pool. Set once by _init_worker.
+_worker_generator = None
+
+
+def _init_worker(season_stats, normalized_season_stats, player_registry, seed):
+    global _worker_generator
+    _worker_generator = TrainingDataGenerator(
+        season_stats=season_stats,
+        normalized_season_stats=normalized_season_stats,
+        player_registry=player_registry,
+        seed=seed,
+    )
+
+
+def _generate_shard_in_worker(shard):
+    path, entry = _worker_generator.generate_shard(*shard)
+    # Send the worker's metrics for this shard back to the parent process.
+    return path, entry, metrics.pop_snapshot()
+
+
+def simulate_league_rows(roto_calculator, feature_matrix, num_simulations):
+    """
+    Simulate leagues and build a row for each team: its feature vector, then its label and sample weight.
+    :param roto_calculator: The RotoCalculator of the season.
+    :param feature_matrix: The season's PlayerRegistry.prev_season_features.
+    :param num_simulations: The number of leagues to simulate.
+    :return: An array of shape (num_simulations * num_teams, num_features + 2).
+    """
+    with metrics.timer("simulation", items=num_simulations):
+        teams, sim_results = roto_calculator.run_simulation_batch(
+            num_simulations=num_simulations
+        )
+    # Extract the feature vector per team, and append the label and the weight.
+    with metrics.timer("feature_extraction", items=teams.shape[0] * teams.shape[1]):
+        features = calculate_team_features(teams, feature_matrix)
+        labels = sim_results["total_fantasy_pts"][..., np.newaxis]
+        weights = sim_results["sample_weight"][..., np.newaxis]
+        rows = np.concatenate([features, labels, weights], axis=-1)
+    return rows.reshape(-1, rows.shape[-1])
 
 
 class TrainingDataGenerator:
-    def __init__(self, season_stats, normalized_season_stats):
+    def __init__(
+        self, season_stats, normalized_season_stats, player_registry=None, seed=None
+    ):
+        """
+        Constructor.
+        :param season_stats: A dictionary with years as keys, and dictionaries of player stats as values.
+        :param normalized_season_stats: The same for the normalized stats.
+        :param player_registry: Optional PlayerRegistry of the seasons. Built from the stats if not given.
+        :param seed: Optional root SeedSequence or integer seed of the simulations. Defaults to Config.random_seed.
+        """
         self.season_stats = season_stats
         self.normalized_season_stats = normalized_season_stats
         self.config = Config()
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(
+                self.config.random_seed if seed is None else seed
+            )
+        self.seed_sequence = seed
+        if player_registry is None:
+            player_registry = PlayerRegistry(
+                season_stats=season_stats,
+                normalized_season_stats=normalized_season_stats,
+                feature_columns=self.config.feature_columns,
+            )
+        self.player_registry = player_registry
+        self.storage = get_storage(self.config.storage_format)
+        # Manifests of the data directories written to, keyed by directory.
+        self.manifests = {}
+        # Digests of the season data, keyed by season (see season_digest).
+        self.season_digests = {}
 
-    def generate_training_data_for_season(self, season, data_type):
-        season_data = self.season_stats[season]
-        roto_calculator = RotoCalculator(season_data=season_data)
-        prev_season_stats = self.normalized_season_stats[season - 1]
+    def season_shards(self, season):
+        """
+        Split the simulations of a season into shards.
+        :param season: The season to simulate.
+        :return: A list of (season, shard_index, start, stop) tuples covering the season's simulations.
+        """
+        num_simulations = self.config.simulations_per_season
+        shard_size = self.config.simulations_per_shard or num_simulations
+        return [
+            (season, shard_index, start, min(start + shard_size, num_simulations))
+            for shard_index, start in enumerate(range(0, num_simulations, shard_size))
+        ]
 
-        data_dir = f"{data_type}_data/{self.config.num_teams}teams_{self.config.team_size}players"
-        if not os.path.exists(data_dir):
-            os.mkdir(data_dir)
+    def shard_seed_sequence(self, season, shard_index):
+        """
+        The RNG stream of a shard, spawned from the root seed by season and then by shard.
+        It depends on neither the worker running the shard nor the batch size, so identical seeds give
+        identical files.
+        """
+        return np.random.SeedSequence(
+            self.seed_sequence.entropy,
+            spawn_key=tuple(self.seed_sequence.spawn_key) + (season, shard_index),
+        )
+
+    def online_seed_sequence(self, epoch, worker_id, num_workers):
+        """
+        The RNG stream of a worker of online training in an epoch. Its spawn key has a different length from
+        the shard keys, so it never repeats the stream of a generated file.
+        """
+        return np.random.SeedSequence(
+            self.seed_sequence.entropy,
+            spawn_key=tuple(self.seed_sequence.spawn_key)
+            + (epoch, worker_id, num_workers),
+        )
+
+    def roto_calculator(self, season, rng):
+        return RotoCalculator(
+            season_data=self.season_stats[season],
+            rng=rng,
+            players=self.player_registry.players[season],
+            draft_order=self.player_registry.draft_order(season),
+        )
+
+    def simulate_shard(self, season, shard_index, start, stop):
+        """
+        Run the simulations [start, stop) of a season and extract their feature rows.
+        The shard draws from its own RNG stream (see shard_seed_sequence), so it produces the same rows
+        whichever process runs it.
+        :return: An array of feature rows, each ending with the label and the sample weight.
+        """
+        seed_sequence = self.shard_seed_sequence(season, shard_index)
+        roto_calculator = self.roto_calculator(
+            season, rng=np.random.default_rng(seed_sequence)
+        )
+        # Normalized previous season stats of the season's players, indexed by player ID.
+        feature_matrix = self.player_registry.prev_season_features(season)
 
         training_data = []
 
-        for i in range(
-            self.config.simulations_per_season
-        ):  # By default, 10k simulations per season.
-            if (i + 1) % 500 == 0:
-                logger.info(
-                    f"Simulation {i+1}/{self.config.simulations_per_season} in year {season}."
-                )
-            sim_results = roto_calculator.run_simulation()
-            for team in sim_results:
-                # The label.
-                total_fantasy_pts = team["total_fantasy_pts"]
-
-                # Extract the feature vector per team.
-                players = team["team"]
-
-                features = calculate_team_prev_season_data(
-                    team=players, prev_season_data=prev_season_stats
-                )
-                features.append(total_fantasy_pts)
-                training_data.append(features)
-
-            # Create CSV files in batches of 10,000 simulations (10k x num_teams rows for each file).
-        df = pd.DataFrame.from_records(
-            training_data, columns=self.config.vector_columns
+        num_simulations = self.config.simulations_per_season
+        batch_size = self.config.simulation_batch_size
+        for batch_start in range(start, stop, batch_size):
+            # By default, 10k simulations per season, run in vectorized batches.
+            size = min(batch_size, stop - batch_start)
+            training_data.append(
+                simulate_league_rows(roto_calculator, feature_matrix, size)
+            )
+            logger.info(
+                f"Simulation {batch_start+size}/{num_simulations} in year {season}."
+            )
+        return np.concatenate(training_data)
+
+    def simulate_season(self, season):
+        """
+        Simulate every shard of a season in memory.
+        :return: The rows that generate_training_data would write for the season, as a float32 array.
+        """
+        return np.concatenate(
+            [self.simulate_shard(*shard) for shard in self.season_shards(season)]
+        ).astype(np.float32)
+
+    def settings_fingerprint(self):
+        """
+        :return: A hash of the settings that determine the rows of a shard, besides its seed and simulations.
+        """
+        settings = {
+            "num_teams": self.config.num_teams,
+            "team_size": self.config.team_size,
+            "feature_columns": self.config.feature_columns,
+            "scoring": self.config.scoring,
+            "league_sampler": self.config.league_sampler,
+            "adp_noise": self.config.adp_noise,
+            "sampler_tiers": self.config.sampler_tiers,
+            "tier_allocation": self.config.tier_allocation,
+            "antithetic_sampling": self.config.antithetic_sampling,
+        }
+        return hashlib.sha1(
+            json.dumps(settings, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def season_digest(self, season):
+        """
+        :return: A hash of the data the rows of a season are built from: its players, their stats as scored by
+            the simulations, their draft order and their previous season features.
+        """
+        if season not in self.season_digests:
+            roto_calculator = self.roto_calculator(season, rng=None)
+            digest = hashlib.sha1(
+                json.dumps(self.player_registry.players[season]).encode("utf-8")
+            )
+            for array in [
+                roto_calculator.season_matrix,
+                roto_calculator.draft_order,
+                self.player_registry.prev_season_features(season),
+            ]:
+                digest.update(np.ascontiguousarray(array).tobytes())
+            self.season_digests[season] = digest.hexdigest()
+        return self.season_digests[season]
+
+    def data_dir(self, data_type):
+        return f"{data_type}_data/{self.config.num_teams}teams_{self.config.team_size}players"
+
+    def shard_prefix(self, season):
+        return f"{season}_{self.config.num_teams}T_{self.config.team_size}P_"
+
+    def shard_path(self, season, data_type, shard_index):
+        file_name = f"{self.shard_prefix(season)}{shard_index:04d}"
+        return os.path.join(
+            self.data_dir(data_type), file_name + self.storage.extension
         )
-        file_name = f"{season}_{self.config.num_teams}T_{self.config.team_size}P.csv"
-        df.to_csv(os.path.join(data_dir, file_name))
-        logger.info(f"Saved CSV file {file_name}.")
 
-    def generate_training_data(
-        self, make_training=True, make_test=True, make_validation=True
-    ):
+    def generate_shard(self, season, data_type, shard_index, start, stop):
+        """
+        Simulate a shard and flush it to its own file in the configured storage format.
+        Files are written under a temporary name and renamed once complete, so an existing file is always a
+        finished shard. Those are skipped, which lets an interrupted run resume where it stopped, if the manifest
+        records that they were generated from the same seed, simulations, settings and season data, with the
+        expected number of rows. Otherwise they are regenerated.
+        :return: A tuple (path, entry), where entry is the manifest entry describing the file.
+        """
+        path = self.shard_path(season, data_type, shard_index)
+        seed_sequence = self.shard_seed_sequence(season, shard_index)
+        entry = {
+            "season": season,
+            "num_teams": self.config.num_teams,
+            "team_size": self.config.team_size,
+            "shard": shard_index,
+            "start": start,
+            "stop": stop,
+            "rows": (stop - start) * self.config.num_teams,
+            "settings": self.settings_fingerprint(),
+            "season_data": self.season_digest(season),
+            "seed": {
+                "entropy": seed_sequence.entropy,
+                "spawn_key": list(seed_sequence.spawn_key),
+            },
+        }
+        if os.path.exists(path):
+            data_dir, file_name = os.path.split(path)
+            recorded = Manifest(data_dir).files.get(file_name)
+            if recorded == entry and len(self.storage.read(path)) == entry["rows"]:
+                logger.info(f"Skipping existing file {file_name}.")
+                return path, entry
+            logger.info(
+                f"Regenerating {file_name}, which was generated from another seed, simulations, settings or "
+                "season data."
+            )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        training_data = self.simulate_shard(season, shard_index, start, stop).astype(
+            np.float32
+        )
+        tmp_path = f"{path}.tmp"
+        with metrics.timer("io_write", items=len(training_data)):
+            self.storage.write(
+                tmp_path, training_data, columns=self.config.data_columns
+            )
+            os.replace(tmp_path, path)
+        logger.info(f"Saved file {os.path.basename(path)}.")
+        return path, entry
+
+    def _manifest(self, data_dir):
+        manifest = self.manifests.get(data_dir)
+        if manifest is None:
+            manifest = self.manifests[data_dir] = Manifest(data_dir)
+        return manifest
+
+    def _record_shard(self, path, entry):
+        data_dir, file_name = os.path.split(path)
+        self._manifest(data_dir).add(
+            file_name, columns=self.config.data_columns, **entry
+        )
+
+    def remove_stale_shards(self, season, data_type):
+        """
+        Delete the files of a season that are no longer part of its shards, i.e. after simulations_per_shard
+        changed, and remove them from the manifest.
+        """
+        data_dir = self.data_dir(data_type)
+        if not os.path.isdir(data_dir):
+            return
+        planned = {
+            os.path.basename(self.shard_path(season, data_type, shard[1]))
+            for shard in self.season_shards(season)
+        }
+        manifest = self._manifest(data_dir)
+        stale = {
+            file_name
+            for file_name in os.listdir(data_dir)
+            if file_name.startswith(self.shard_prefix(season))
+            and file_name.endswith(self.storage.extension)
+        }
+        stale |= {
+            file_name
+            for file_name, entry in manifest.files.items()
+            if entry.get("season") == season
+        }
+        for file_name in sorted(stale - planned):
+            logger.info(f"Removing stale file {file_name}.")
+            if os.path.exists(os.path.join(data_dir, file_name)):
+                os.remove(os.path.join(data_dir, file_name))
+            manifest.remove(file_name)
+
+    def generate_training_data_for_season(self, season, data_type):
+        for shard in self.season_shards(season):
+            self._record_shard(*self.generate_shard(season, data_type, *shard[1:]))
+        self.remove_stale_shards(season, data_type)
+
+    def _seasons_to_generate(self, make_training, make_test, make_validation):
+        seasons = []
         if make_training:
-            for year in self.config.training_years:
-                logger.info(f"Generating training data for year {year} ...")
-                self.generate_training_data_for_season(
-                    season=year, data_type="training"
-                )
+            seasons += [(year, "training") for year in self.config.training_years]
         if make_test:
-            for year in self.config.test_years:
-                logger.info(f"Generating test data for year {year} ...")
-                self.generate_training_data_for_season(season=year, data_type="test")
+            seasons += [(year, "test") for year in self.config.test_years]
         if make_validation:
-            for year in self.config.validation_years:
-                logger.info(f"Generating test data for year {year} ...")
-                self.generate_training_data_for_season(
-                    season=year, data_type="validation"
-                )
+            seasons += [(year, "validation") for year in self.config.validation_years]
+        return seasons
+
+    def generate_training_data(
+        self,
+        make_training=True,
+        make_test=True,
+        make_validation=True,
+        num_workers=None,
+    ):
+        """
+        Generate the data files for every requested season.
+        :param num_workers: Number of worker processes. Defaults to Config.num_workers.
+            With more than 1 worker, the shards of all seasons are fanned out over a process pool.
+        :return: None
+        """
+        seasons = self._seasons_to_generate(make_training, make_test, make_validation)
+        num_workers = num_workers or self.config.num_workers
+        if num_workers <= 1:
+            with profile("data_generation"):
+                for year, data_type in seasons:
+                    logger.info(f"Generating {data_type} data for year {year} ...")
+                    self.generate_training_data_for_season(
+                        season=year, data_type=data_type
+                    )
+            metrics.report(logger, label="data generation")
+            return
+
+        shards = [
+            (year, data_type) + shard[1:]
+            for year, data_type in seasons
+            for shard in self.season_shards(year)
+        ]
+        logger.info(
+            f"Generating data for {len(seasons)} seasons in {len(shards)} shards on {num_workers} workers ..."
+        )
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=_init_worker,
+            initargs=(
+                self.season_stats,
+                self.normalized_season_stats,
+                self.player_registry,
+                self.seed_sequence,
+            ),
+        ) as executor:
+            # Workers write their own shard files, only the manifest entries come back.
+            for path, entry, snapshot in executor.map(
+                _generate_shard_in_worker, shards
+            ):
+                metrics.merge(snapshot)
+                self._record_shard(path, entry)
+        for year, data_type in seasons:
+            self.remove_stale_shards(year, data_type)
+        metrics.report(logger, label="data generation")
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 def calculate_team_prev_season_data(team, prev_season_data):
     """
     Return a list of size 15, where the items represent the following average attributes for the team:
@@ -36,3 +39,32 @@ def calculate_team_prev_season_data(team, prev_season_data):
         # Divide by the number of players on the team to get the average.
         team_features.append(team_info[feature] / num_players)
     return team_features
+
+
+def prev_season_feature_matrix(players, prev_season_data, feature_columns):
+    """
+    Precompute the normalized previous season stats of every player of a season into one array,
+    so team features can be gathered by index instead of looked up by name.
+    :param players: A list of player names. Row i of the matrix belongs to players[i].
+    :param prev_season_data: A dictionary with player names as keys and their normalized prev season data as values.
+    :param feature_columns: The stats to use as features, in order.
+    :return: A float64 array of shape (len(players), len(feature_columns)).
+    """
+    return np.array(
+        [
+            [prev_season_data[player][stat] for stat in feature_columns]
+            for player in players
+        ],
+        dtype=np.float64,
+    )
+
+
+def calculate_team_features(rosters, feature_matrix):
+    """
+    Vectorized version of calculate_team_prev_season_data for any number of teams.
+    :param rosters: An integer array of shape (..., team_size) of rows in feature_matrix.
+    :param feature_matrix: An array from prev_season_feature_matrix.
+    :return: An array of shape (..., num_features) with the average features of each team.
+    """
+    # Summing along the roster axis adds the players in order, like calculate_team_prev_season_data.
+    return feature_matrix[rosters].sum(axis=-2) / rosters.shape[-1]
@@ -0,0 +1,160 @@
+"""
+Expected roto points and win probabilities for a fixed set of rosters, i.e. our actual league.
+The exact evaluation scores the rosters on the players' season totals, with the league's ScoringPlan
+(ratio categories such as FG% as ratios of sums, turnovers ranked ascending).
+The Monte-Carlo evaluation resamples the teams' season totals and scores all the resampled leagues in vectorized
+batches. Rather than resampling every player's games, it draws each team total from the normal distribution
+that the sum of its players' per-game outcomes converges to (see _resample_totals). This is a deliberate
+approximation: the totals of a 13-player team over a season are sums of hundreds of games, and drawing them
+directly takes team_size times fewer random numbers.
+"""
+import numpy as np
+
+from roto_calculator import RotoCalculator, season_matrix_from_dict
+
+# Points are not sampled on their own, but computed from the sampled makes: 2 per field goal, 1 more per three
+# (which is also a field goal), and 1 per free throw.
+POINTS_COMPONENTS = {"FG": 2, "3P": 1, "FT": 1}
+
+
+class WinProbabilityEngine:
+    def __init__(self, season_data, rosters, rng=None, players=None, scoring_plan=None):
+        """
+        Constructor.
+        :param season_data: A dictionary with players as keys and their attributes as values.
+        :param rosters: A list with the player names of each team.
+        :param rng: Optional numpy Generator used for resampling.
+        :param players: Optional list of the player names by ID, i.e. from a PlayerRegistry.
+        :param scoring_plan: Optional ScoringPlan. Defaults to the plan compiled from Config.scoring.
+        """
+        self.roto_calculator = RotoCalculator(
+            season_data, rng=rng, players=players, scoring_plan=scoring_plan
+        )
+        self.rng = self.roto_calculator.rng
+        self.scoring_plan = self.roto_calculator.scoring_plan
+        player_ids = {
+            player: player_id
+            for player_id, player in enumerate(self.roto_calculator.players)
+        }
+        try:
+            self.rosters = np.array(
+                [[player_ids[player] for player in roster] for roster in rosters]
+            )
+        except KeyError as e:
+            raise LookupError(f"Player {e.args[0]} not found in dataset.")
+        self.num_teams = len(self.rosters)
+
+        # The sampled stats: the stats of the scoring plan, followed by the makes that points are computed from
+        # when they are not scored themselves.
+        self.stats = list(self.scoring_plan.stats)
+        if "PTS" in self.stats:
+            self.stats += [stat for stat in POINTS_COMPONENTS if stat not in self.stats]
+        # Season totals of the rostered players, shape (num_teams, team_size, len(stats)).
+        self.player_totals = season_matrix_from_dict(
+            season_data, self.stats, players=self.roto_calculator.players
+        )[self.rosters]
+
+    def exact(self):
+        """
+        Score the rosters on the players' actual season totals.
+        :return: The dictionary returned by ScoringPlan.score, for a single league.
+        """
+        totals = self.player_totals.sum(axis=1)[..., : len(self.scoring_plan.stats)]
+        results = self.scoring_plan.score(totals[np.newaxis])
+        return {key: value[0] for key, value in results.items()}
+
+    def _resample_totals(self, num_resamples):
+        """
+        Resample the season totals of every team.
+        Each counting stat is the sum of a player's games. With per-game outcomes distributed like a Poisson
+        variable, a player's season total is approximately normal with variance equal to its mean (times
+        dispersion). The makes of ratio categories are binomial given the attempts, at the player's actual
+        percentage.
+        The players are independent, so each team total is normal as well, and makes and attempts are jointly
+        normal. Drawing the team totals directly is equivalent to drawing every player and summing, with
+        team_size times fewer random numbers.
+        Points are computed from the sampled makes (see POINTS_COMPONENTS), so they move together with the
+        shooting categories. The other counting stats are independent of each other.
+        :return: An array of shape (num_resamples, num_teams, len(scoring_plan.stats)) of team totals.
+        """
+        shape = (num_resamples, self.num_teams)
+        noise = self.rng.standard_normal(shape + (len(self.stats),), dtype=np.float32)
+        samples = self.team_means + noise * self.team_stds
+        for makes, attempts, makes_given_attempts in self._shooting_stats:
+            # Add the part of the makes explained by the resampled attempts.
+            samples[..., makes] += noise[..., attempts] * makes_given_attempts
+        np.maximum(samples, 0, out=samples)
+        if "PTS" in self.stats:
+            samples[..., self.stats.index("PTS")] = sum(
+                points * samples[..., self.stats.index(stat)]
+                for stat, points in POINTS_COMPONENTS.items()
+            )
+        return samples[..., : len(self.scoring_plan.stats)]
+
+    def _fit_team_distributions(self, dispersion):
+        """
+        Compute the mean and standard deviation of every team total, and the dependence of the makes on the
+        attempts, from the players' season totals.
+        """
+        totals = self.player_totals.astype(np.float64)
+        self.team_means = totals.sum(axis=1).astype(np.float32)
+        variances = dispersion * totals.sum(axis=1)
+        self._shooting_stats = []
+        for makes, attempts in zip(
+            self.scoring_plan.ratio_numerators, self.scoring_plan.ratio_denominators
+        ):
+            player_attempts = totals[..., attempts]
+            pct = np.divide(
+                totals[..., makes],
+                player_attempts,
+                out=np.zeros_like(player_attempts),
+                where=player_attempts > 0,
+            )
+            # Var(makes) = Var(E[makes | attempts]) + E[Var(makes | attempts)].
+            attempts_variance = variances[:, attempts]
+            covariance = dispersion * (pct * player_attempts).sum(axis=1)
+            makes_variance = dispersion * (pct**2 * player_attempts).sum(axis=1) + (
+                pct * (1 - pct) * player_attempts
+            ).sum(axis=1)
+            makes_given_attempts = np.divide(
+                covariance,
+                np.sqrt(attempts_variance),
+                out=np.zeros_like(covariance),
+                where=attempts_variance > 0,
+            )
+            variances[:, makes] = makes_variance - makes_given_attempts**2
+            self._shooting_stats.append(
+                (makes, attempts, makes_given_attempts.astype(np.float32))
+            )
+        self.team_stds = np.sqrt(np.maximum(variances, 0)).astype(np.float32)
+
+    def simulate(self, num_resamples=100000, batch_size=10000, dispersion=1.0):
+        """
+        Estimate every team's expected points and probability of winning the league.
+        :param num_resamples: Number of resampled seasons.
+        :param batch_size: Number of resampled seasons scored together.
+        :param dispersion: Scales the per-game variance of the counting stats. 1 is Poisson.
+        :return: A dictionary with the keys being:
+            - 'expected_pts' - (num_teams,) expected total points.
+            - 'expected_category_pts' - (num_teams, num_categories) expected points per category.
+            - 'win_probability' - (num_teams,) probability of finishing first. Ties for first are shared.
+            - 'categories' - the category names.
+        """
+        self._fit_team_distributions(dispersion)
+        total_pts = np.zeros(self.num_teams)
+        category_pts = np.zeros((self.num_teams, self.scoring_plan.num_categories))
+        wins = np.zeros(self.num_teams)
+        for start in range(0, num_resamples, batch_size):
+            size = min(batch_size, num_resamples - start)
+            results = self.scoring_plan.score(self._resample_totals(size))
+            points = results["total_fantasy_pts"]
+            total_pts += points.sum(axis=0)
+            category_pts += results["rankings"].sum(axis=0)
+            winners = points == points.max(axis=1, keepdims=True)
+            wins += (winners / winners.sum(axis=1, keepdims=True)).sum(axis=0)
+        return {
+            "expected_pts": total_pts / num_resamples,
+            "expected_category_pts": category_pts / num_resamples,
+            "win_probability": wins / num_resamples,
+            "categories": list(self.scoring_plan.categories),
+        }